@@ -1,22 +1,78 @@
-from flask import Flask, request, jsonify, render_template, send_from_directory, session
+from flask import Flask, Response, request, jsonify, render_template, send_from_directory, session, stream_with_context, url_for
 import video_processing_refactored as vp
+import jobs
+import result_store
 import json
+import logging
 import os
-import cv2
-import base64
 
 app = Flask(__name__, template_folder='templates', static_folder='static')
 
-global_video_path = None
-global_top_action_scenes = None
-
 @app.route('/')
 def home():
     return render_template('index.html')
 
+PIPELINE_STAGES = ('download', 'analyse', 'results')
+
+def scene_result(scene_id, scene_info):
+    thumbnail_filename = vp.save_thumbnail(scene_info['first_frame'])
+    return {
+        'scene_id': scene_id,
+        'category': scene_info['category'],
+        'confidence': scene_info['confidence'],
+        'start_time': scene_info['start_time'],
+        'end_time': scene_info['end_time'],
+        'duration': scene_info['duration'],
+        'best_description': scene_info['best_description'],
+        'thumbnail_url': f'/thumbnails/{thumbnail_filename}',  # For display; runs outside a request, so no url_for
+    }
+
+def report_download(job, download):
+    progress = download.progress
+    if progress.done and progress.error is None:
+        job.update_stage('download', status='done')
+    elif progress.size:
+        job.update_stage('download', progress.available / progress.size)
+
+def run_video_pipeline(job, video_url, description_phrases):
+    job.update_stage('download')
+    # A low-resolution stream is enough for detection and CLIP; exports fetch a high-resolution one.
+    # Analysis follows the download instead of waiting for it to finish.
+    download = vp.start_video_download(video_url, profile='analysis')
+
+    job.update_stage('analyse')
+    # Jobs on the same video share the detection and embedding pass, even with different phrases
+    scene_frames, embedding_batches = vp.share_video_embeddings(download)
+    total_frames = None
+    results = []
+    for scene_id, scene_info in vp.iter_classified_scenes(scene_frames, embedding_batches, description_phrases):
+        # Built once: the published dict is also the final result, so each thumbnail is encoded once
+        result = scene_result(scene_id, scene_info)
+        results.append(result)
+        job.publish('scene', result)
+        report_download(job, download)
+        if total_frames is None and download.progress.done:
+            total_frames = vp.video_frame_count(download.result())
+        if total_frames:
+            job.update_stage('analyse', scene_frames[scene_id]['end_time'].get_frames() / total_frames)
+    video_path = download.result()
+    # This job's thumbnails were just written or touched, so only older ones are evicted
+    vp.prune_thumbnails()
+    job.update_stage('download', status='done')
+    job.update_stage('analyse', status='done')
+
+    job.update_stage('results')
+    top_action_scenes = sorted([scene for scene in results if scene['category'] == 'Action Scene'], key=lambda x: x['confidence'], reverse=True)[:10]
+
+    # Keyed by the job id so /concatenate_clips works from any worker sharing the store
+    result_store.get_store().put(job.id, {'video_url': video_url, 'video_path': video_path, 'all_scenes': results, 'top_action_scenes': top_action_scenes})
+    job.publish('summary', {'top_action_scenes': top_action_scenes})
+    job.update_stage('results', status='done')
+
+    return {'all_scenes': results, 'top_action_scenes': top_action_scenes}
+
 @app.route('/process_video', methods=['POST'])
 def process_video():
-    global global_video_path, global_top_action_scenes
     data = request.get_json()
     video_url = data.get('video_url')
     category_choice = data.get('category_choice')
@@ -24,96 +80,135 @@ def process_video():
 
     if not video_url:
         return jsonify({'error': 'No video URL provided'}), 400
-    
-    video_path = vp.download_video(video_url)
-    if not video_path:
-        return jsonify({'error': 'Failed to download video'}), 500
-
-    scenes = vp.find_scenes(video_path)
-    scene_frames = vp.extract_frames(video_path, scenes)
-    
-    description_phrases = {
-        "1": ["Mountain biker doing a downhill run", "Rider jumping over an obstacle", "Cyclist on a rocky trail", "Biking through forest trails", "MTB stunt on a dirt path",
-            "Close-up of a mountain bike wheel", "Mountain biker navigating a sharp turn", "First-person view of a bike ride", "Mountain biker doing a trick jump", "Biking fast down a steep incline",
-            "Biker with a helmet on talking to the camera", "People standing around", "a person facing and talking to the camera", "Introducing the context for a video", "a zoomed-out scene of nature without any people in it",
-            "Scene showing a mountain biking terrain park", "Biker taking it easy going down a hill", "mountain Biker falling and crashing", "People walking outside", "Context scene with mountain bikers not performing any tricks"],  # Example phrases for categories
-        "2": ["Skier jumping off a snow ramp", "Person skiing down a snowy mountain", "Close-up of skis on snow", "Skiing through a snowy forest", "Skier performing a spin",
-            "Point-of-view shot from a ski helmet", "Group of skiers on a mountain", "Skier sliding on a rail", "Snow spraying from skis", "Skier in mid-air during a jump",
-            "Person being interviewed after an event", "People in a crowd cheering", "Sitting inside of a vehicle", "Skaters standing around a ramp", "People standing around at an event",
-            "Commercial break", "People having a conversation", "Person in a helmet talking to the camera", "person facing the camera", "People introducing the context for a video",],
-        "3": ["Surfer riding a big wave", "Close-up of a surfboard on water", "Surfer performing a cutback", "Wave curling over a surfer", "Aerial view of a surf competition",
-            "Surfer paddling on a board", "Surfboard leaving a trail in the water", "Surfer in a tube wave", "Surfer wiping out on a wave", "Longboard surfer cruising a wave",
-            "Surfers lounging on the beach", "Paddling to catch a wave", "a surfer surveying the waves sitting on their surfboard", "People standing holding their surfboards",
-            "Standing on the beach", "Interviewing a surfer after their performance", "multiple faces in the frame", "Surfer paddling out to get ready for a wave",
-            "Surfer in the water sitting on their surfboard", "Beginner surfer struggling to stand on their board"]
-    }[category_choice]
+    if category_choice not in vp.CATEGORY_PHRASES:
+        return jsonify({'error': 'Unknown category'}), 400
+
+    description_phrases = list(vp.CATEGORY_PHRASES[category_choice])
 
     # Replace the first few phrases with custom phrases if provided
     for i, phrase in enumerate(custom_phrases):
         if phrase:  # Only replace if a custom phrase was actually provided
             description_phrases[i] = phrase
-    
-    scene_categories = vp.classify_and_categorize_scenes(scene_frames, description_phrases)
-
-    results = []
-    for scene_id, scene_info in scene_categories.items():
-        encoded_image = base64.b64encode(cv2.imencode('.jpg', scene_info['first_frame'])[1]).decode()
-        results.append({
-            'scene_id': scene_id,
-            'category': scene_info['category'],
-            'confidence': scene_info['confidence'],
-            'start_time': scene_info['start_time'],
-            'end_time': scene_info['end_time'],
-            'duration': scene_info['duration'],
-            'best_description': scene_info['best_description'],
-            'image': encoded_image,  # For display
-
-        })
 
-
-    global_video_path = video_path
-
-    global_top_action_scenes = sorted([scene for scene in results if scene['category'] == 'Action Scene'], key=lambda x: x['confidence'], reverse=True)[:10]
-
-    return jsonify({'all_scenes': results, 'top_action_scenes': global_top_action_scenes})
+    # Identical requests arriving while one is in progress attach to the same job
+    job_key = json.dumps([vp.video_id(video_url), description_phrases, vp.analysis_config()], sort_keys=True)
+    job = jobs.get_backend().submit(run_video_pipeline, video_url, description_phrases, stages=PIPELINE_STAGES, key=job_key)
+    return jsonify({'job_id': job.id, 'status_url': url_for('job_status', job_id=job.id), 'events_url': url_for('job_events', job_id=job.id)}), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = jobs.get_backend().get(job_id)
+    if job is None:
+        # The job may have run on another worker; its stored result is still available
+        stored = result_store.get_store().get(job_id)
+        if stored is None:
+            return jsonify({'error': 'Unknown job'}), 404
+        return jsonify({'job_id': job_id, 'status': 'finished', 'result': {'all_scenes': stored['all_scenes'], 'top_action_scenes': stored['top_action_scenes']}})
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Server-Sent Events stream of a job's scenes as they are classified."""
+    job = jobs.get_backend().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+
+    def generate():
+        cursor = 0
+        while True:
+            events, done = job.wait_for_events(cursor, timeout=15)
+            cursor += len(events)
+            for event, data in events:
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+            if done and not events:
+                yield f"event: status\ndata: {json.dumps({'status': job.status, 'error': job.error})}\n\n"
+                return
+            if not events:
+                yield ": keep-alive\n\n"
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/concatenate_clips', methods=['POST'])
 def concatenate_clips():
-    global global_video_path, global_top_action_scenes
-
     data = request.get_json()
+    job_id = data.get('job_id')
     selected_indices = data.get('selected_indices', [])
     caption_text = data.get('caption_text', '')  # Optional caption text
     audio_url = data.get('audio_url', None)  # Optional audio URL
+    export_scene_clips = data.get('export_clips', False)  # Optionally also write each selected scene as its own clip
 
-    if not global_video_path or not global_top_action_scenes:
+    stored = result_store.get_store().get(job_id) if job_id else None
+    if not stored or not stored['top_action_scenes']:
         return jsonify({'error': 'Video data not available, please process a video first.'}), 400
+    top_action_scenes = stored['top_action_scenes']
+
+    selected_scenes = []
+    for index in selected_indices:
+        index = int(index)  # Ensure index is an integer
+        if index < 0 or index >= len(top_action_scenes):
+            return jsonify({'error': f'Index {index} out of range'}), 400
+        selected_scenes.append((index, top_action_scenes[index]))
+
+    # Scenes were found on the analysis stream; cut them from the high-resolution export stream,
+    # fetching only the byte ranges around the selected scenes
+    intervals = [(vp.convert_timestamp_to_seconds(scene_info['start_time']), vp.convert_timestamp_to_seconds(scene_info['end_time']))
+                 for _, scene_info in selected_scenes]
+    try:
+        segments = vp.download_segments(stored['video_url'], intervals, profile='export')
+    except Exception as e:
+        logging.warning(f"Segment download failed, falling back to the full video: {e}")
+        segments = None
+    video_path = None
+    if segments is None or export_scene_clips:
+        # The stored video_path is the low-resolution analysis stream, so it is no substitute here
+        try:
+            video_path = vp.download_video(stored['video_url'], profile='export')
+        except Exception as e:
+            logging.error(f"Export stream download failed for job {job_id}: {e}")
+            return jsonify({'error': f'Failed to download video: {e}'}), 502
+        if not video_path:
+            return jsonify({'error': 'No export stream available for this video'}), 502
+    if segments is None:
+        segments = [(video_path, start, end) for start, end in intervals]
 
     audio_path = None
     if audio_url:
-        audio_path = vp.download_video(audio_url)
+        try:
+            audio_path = vp.download_audio(audio_url, duration=sum(end - start for _, start, end in segments))
+        except Exception as e:
+            logging.error(f"Audio download failed for job {job_id}: {e}")
+            return jsonify({'error': f'Failed to download audio: {e}'}), 502
         if not audio_path:
             return jsonify({'error': 'Failed to download audio'}), 400
 
+    # Outputs are named by job, so old jobs' videos and clips are deleted here rather than overwritten
+    vp.prune_job_outputs(os.path.join(app.static_folder, 'videos'))
     try:
-        clip_paths = []
-        for index in selected_indices:
-            index = int(index)  # Ensure index is an integer
-            if index < 0 or index >= len(global_top_action_scenes):
-                return jsonify({'error': f'Index {index} out of range'}), 400
-            scene_info = global_top_action_scenes[index]
-            clip_info = vp.save_clip(global_video_path, scene_info, os.path.join(app.static_folder, 'videos'), index)
-            if clip_info is None:
-                return jsonify({'error': 'Failed to save some clips'}), 500
-            clip_paths.append(clip_info['path'])
+        # Named by job so concurrent renders do not overwrite each other
+        final_video_info = vp.render_segments(segments, os.path.join(app.static_folder, 'videos', f'{job_id}_final_video.mp4'), caption=caption_text, audio_path=audio_path)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
-    
-    final_video_info = vp.process_video(clip_paths, os.path.join(app.static_folder, 'videos', 'final_video.mp4'), caption=caption_text, audio_path=audio_path)
     if 'path' not in final_video_info:
         return jsonify({'error': 'Failed to process final video'}), 500
 
-    return jsonify({'message': 'Video processed successfully', 'video_filename': os.path.basename(final_video_info['path'])})
+    response = {'message': 'Video processed successfully', 'video_filename': os.path.basename(final_video_info['path'])}
+    if export_scene_clips:
+        try:
+            clip_paths = vp.export_clips(video_path, selected_scenes, os.path.join(app.static_folder, 'videos'), job_id=job_id)
+        except vp.ClipExportError as e:
+            return jsonify({'error': str(e), 'failed_clips': e.failures}), 500
+        response['clip_filenames'] = [os.path.basename(path) for path in clip_paths]
+
+    return jsonify(response)
+
+@app.route('/thumbnails/<path:filename>', methods=['GET'])
+def thumbnail(filename):
+    # Thumbnail names are content hashes, so a given URL never changes and can be cached for long
+    response = send_from_directory(os.path.abspath(vp.THUMBNAIL_DIRECTORY), filename, max_age=vp.THUMBNAIL_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 @app.route('/downloads/<path:filename>', methods=['GET'])
 def download(filename):
@@ -0,0 +1,67 @@
+"""Compare frame sampling strategies against classifying every frame.
+
+Usage: python benchmark_sampling.py VIDEO_PATH [CATEGORY]
+
+For each sampling mode this prints the number of frames scored by CLIP, the
+extraction + classification time, and how closely the scene categories match
+the exhaustive 'all' baseline.
+"""
+import sys
+import time
+
+import video_processing_refactored as vp
+
+
+def run(video_path, scenes, phrases, sampling):
+    started = time.perf_counter()
+    scene_frames = vp.scene_metadata(scenes)
+    frame_count = 0
+
+    # Frames are counted as they stream past, so even the 'all' baseline holds one batch at a time
+    def counted(frame_batches):
+        nonlocal frame_count
+        for batch in frame_batches:
+            frame_count += len(batch)
+            yield batch
+
+    frame_batches = counted(vp.iter_frame_batches(video_path, scene_frames, sampling))
+    categories = vp.classify_and_categorize_scenes(scene_frames, phrases, frame_batches=frame_batches)
+    return categories, frame_count, time.perf_counter() - started
+
+
+def compare(reference, candidate):
+    shared = [scene_id for scene_id in reference if scene_id in candidate]
+    if not shared:
+        return 0.0, 0.0
+    agreement = sum(reference[i]['category'] == candidate[i]['category'] for i in shared) / len(reference)
+    confidence_error = sum(abs(reference[i]['confidence'] - candidate[i]['confidence']) for i in shared) / len(shared)
+    return agreement, confidence_error
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    video_path = sys.argv[1]
+    phrases = vp.CATEGORY_PHRASES[sys.argv[2] if len(sys.argv) > 2 else "1"]
+
+    scenes = vp.find_scenes(video_path)
+    reference, reference_frames, reference_seconds = run(video_path, scenes, phrases, vp.DEFAULT_FRAME_SAMPLING._replace(mode='all'))
+
+    rows = [('all', reference_frames, reference_seconds, 1.0, 0.0)]
+    for mode in vp.FRAME_SAMPLING_MODES:
+        if mode == 'all':
+            continue
+        categories, frame_count, seconds = run(video_path, scenes, phrases, vp.DEFAULT_FRAME_SAMPLING._replace(mode=mode))
+        agreement, confidence_error = compare(reference, categories)
+        rows.append((mode, frame_count, seconds, agreement, confidence_error))
+
+    print(f"\n{len(scenes)} scenes")
+    print(f"{'mode':<10} {'frames':>8} {'seconds':>9} {'speedup':>8} {'agreement':>10} {'conf err':>9}")
+    for mode, frame_count, seconds, agreement, confidence_error in rows:
+        speedup = reference_seconds / seconds if seconds else float('inf')
+        print(f"{mode:<10} {frame_count:>8} {seconds:>9.2f} {speedup:>7.1f}x {agreement:>10.1%} {confidence_error:>9.3f}")
+
+
+if __name__ == '__main__':
+    main()
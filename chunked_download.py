@@ -0,0 +1,282 @@
+import http.client
+import json
+import logging
+import os
+import re
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+# Size of each byte-range request; large enough to amortise request latency, small enough to retry cheaply
+DOWNLOAD_CHUNK_BYTES = int(os.environ.get('DOWNLOAD_CHUNK_BYTES', 8 * 1024 ** 2))
+
+# Number of chunks fetched concurrently for one file
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', 4))
+
+# Attempts per chunk before the download is abandoned (and left resumable)
+DOWNLOAD_CHUNK_RETRIES = int(os.environ.get('DOWNLOAD_CHUNK_RETRIES', 3))
+
+DOWNLOAD_TIMEOUT = float(os.environ.get('DOWNLOAD_TIMEOUT', 30))
+
+READ_BYTES = 1024 ** 2
+MAX_REDIRECTS = 5
+
+
+class HTTPConnectionPool:
+    """Keep-alive HTTP(S) connections, one per host and thread, reused across requests."""
+
+    def __init__(self, timeout=DOWNLOAD_TIMEOUT):
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self, scheme, netloc):
+        connections = self._local.__dict__.setdefault('connections', {})
+        connection = connections.get((scheme, netloc))
+        if connection is None:
+            connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            connection = connection_class(netloc, timeout=self.timeout)
+            connections[(scheme, netloc)] = connection
+        return connection
+
+    def discard(self, scheme, netloc):
+        connection = self._local.__dict__.get('connections', {}).pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def request(self, url, headers=None):
+        """GET url following redirects; the caller must read the response to the end before the next request."""
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            target = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            try:
+                connection = self._connection(parts.scheme, parts.netloc)
+                connection.request('GET', target, headers=headers or {})
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                # The server closed an idle keep-alive connection; retry once on a fresh one
+                self.discard(parts.scheme, parts.netloc)
+                connection = self._connection(parts.scheme, parts.netloc)
+                connection.request('GET', target, headers=headers or {})
+                response = connection.getresponse()
+            except Exception:
+                self.discard(parts.scheme, parts.netloc)
+                raise
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                response.read()
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                continue
+            return response
+        raise http.client.HTTPException(f"Too many redirects fetching {url}")
+
+
+class DownloadProgress:
+    """The file a download is writing and how many bytes from its start are complete.
+
+    Lets a reader follow the download head (see downloads.ProgressiveDownload) instead of
+    waiting for the whole file.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.size = None
+        self.available = 0
+        self.done = False
+        self.error = None
+        self._changed = threading.Condition()
+
+    def start(self, path, size=None):
+        with self._changed:
+            self.path, self.size = path, size
+            self._changed.notify_all()
+
+    def advance(self, available):
+        with self._changed:
+            self.available = max(self.available, available)
+            self._changed.notify_all()
+
+    def finish(self, path=None):
+        """Mark the download complete. path is where the file ended up; readers that already
+        opened it under its old name keep reading the same file."""
+        with self._changed:
+            if path is not None:
+                self.path = path
+                self.available = os.path.getsize(path)
+            self.done = True
+            self._changed.notify_all()
+
+    def fail(self, error):
+        with self._changed:
+            self.error = error
+            self.done = True
+            self._changed.notify_all()
+
+    def wait(self, offset, timeout=None):
+        """Block until bytes past offset are complete or the download ends; return (path, available, done)."""
+        with self._changed:
+            self._changed.wait_for(lambda: (self.path is not None and self.available > offset) or self.done, timeout)
+            if self.error is not None:
+                raise self.error
+            return self.path, self.available, self.done
+
+
+class ChunkedDownloader:
+    """Downloads a URL as parallel byte-range chunks into a preallocated file.
+
+    Completed chunks are recorded in a checkpoint next to the file, so calling download() again
+    after a failure only fetches the chunks that are still missing. Servers that ignore Range
+    requests are read sequentially instead.
+    """
+
+    def __init__(self, chunk_bytes=DOWNLOAD_CHUNK_BYTES, max_workers=DOWNLOAD_WORKERS,
+                 retries=DOWNLOAD_CHUNK_RETRIES, pool=None):
+        self.chunk_bytes = chunk_bytes
+        self.max_workers = max_workers
+        self.retries = retries
+        self.pool = pool or HTTPConnectionPool()
+
+    @staticmethod
+    def checkpoint_path(path):
+        return f"{path}.chunks"
+
+    def probe(self, url):
+        """Return (size in bytes, whether the server honours Range requests); size is None if unknown."""
+        response = self.pool.request(url, headers={'Range': 'bytes=0-0'})
+        try:
+            if response.status == 206:
+                match = re.match(r'bytes\s+\d+-\d+/(\d+)', response.getheader('Content-Range', ''))
+                if match:
+                    return int(match.group(1)), True
+            elif response.status != 200:
+                raise http.client.HTTPException(f"HTTP {response.status} probing {url}")
+            length = response.getheader('Content-Length')
+            return (int(length) if length else None), False
+        finally:
+            # Closing a 200 response drops the connection rather than reading the whole body
+            if response.status == 206:
+                response.read()
+            else:
+                response.close()
+                self.pool.discard(*urllib.parse.urlsplit(url)[:2])
+
+    def download(self, url, path, progress=None):
+        """Write the resource at url to path, resuming from path's checkpoint if there is one.
+
+        A DownloadProgress is kept up to date with the contiguous prefix written so far; chunks
+        are fetched in order, so that prefix grows steadily.
+        """
+        size, supports_ranges = self.probe(url)
+        if not supports_ranges or not size:
+            self._download_sequential(url, path, progress)
+            return
+
+        chunks = [(start, min(start + self.chunk_bytes, size) - 1) for start in range(0, size, self.chunk_bytes)]
+        done = self._load_checkpoint(path, size)
+        if done:
+            logging.info(f"Resuming download of {path}: {len(done)}/{len(chunks)} chunks already present")
+        else:
+            self._preallocate(path, size)
+
+        checkpoint_lock = threading.Lock()
+        contiguous_chunks = 0
+
+        def report_progress():
+            nonlocal contiguous_chunks
+            while contiguous_chunks in done:
+                contiguous_chunks += 1
+            if progress is not None and contiguous_chunks:
+                progress.advance(chunks[contiguous_chunks - 1][1] + 1)
+
+        if progress is not None:
+            progress.start(path, size)
+        report_progress()
+
+        def fetch(index):
+            start, end = chunks[index]
+            self._fetch_chunk(url, path, start, end)
+            with checkpoint_lock:
+                done.add(index)
+                self._save_checkpoint(path, size, done)
+                report_progress()
+
+        missing = [index for index in range(len(chunks)) if index not in done]
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(missing)))) as executor:
+            # list() re-raises the first chunk failure; finished chunks stay checkpointed for the next attempt
+            list(executor.map(fetch, missing))
+
+        try:
+            os.remove(self.checkpoint_path(path))
+        except FileNotFoundError:
+            pass
+
+    def _fetch_chunk(self, url, path, start, end):
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.pool.request(url, headers={'Range': f'bytes={start}-{end}'})
+                if response.status != 206:
+                    response.close()
+                    raise http.client.HTTPException(f"HTTP {response.status} for bytes {start}-{end}")
+                written = 0
+                with open(path, 'r+b') as f:
+                    f.seek(start)
+                    while True:
+                        data = response.read(READ_BYTES)
+                        if not data:
+                            break
+                        f.write(data)
+                        written += len(data)
+                if written != end - start + 1:
+                    raise http.client.IncompleteRead(b'', end - start + 1 - written)
+                return
+            except (OSError, http.client.HTTPException) as e:
+                self.pool.discard(*urllib.parse.urlsplit(url)[:2])
+                if attempt == self.retries:
+                    raise
+                logging.warning(f"Retrying bytes {start}-{end} of {path}: {e}")
+                time.sleep(2 ** attempt)
+
+    def _download_sequential(self, url, path, progress=None):
+        response = self.pool.request(url)
+        if response.status != 200:
+            response.close()
+            raise http.client.HTTPException(f"HTTP {response.status} fetching {url}")
+        with open(path, 'wb') as f:
+            if progress is not None:
+                progress.start(path)
+            written = 0
+            while True:
+                data = response.read(READ_BYTES)
+                if not data:
+                    break
+                f.write(data)
+                written += len(data)
+                if progress is not None:
+                    f.flush()
+                    progress.advance(written)
+
+    @staticmethod
+    def _preallocate(path, size):
+        with open(path, 'wb') as f:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(f.fileno(), 0, size)
+            else:
+                f.truncate(size)
+
+    def _load_checkpoint(self, path, size):
+        """Return the indices of chunks already in path, or an empty set if it cannot be resumed."""
+        try:
+            with open(self.checkpoint_path(path)) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return set()
+        if (checkpoint.get('size') != size or checkpoint.get('chunk_bytes') != self.chunk_bytes
+                or not os.path.exists(path) or os.path.getsize(path) != size):
+            return set()
+        return set(checkpoint.get('done', []))
+
+    def _save_checkpoint(self, path, size, done):
+        checkpoint_path = self.checkpoint_path(path)
+        tmp_path = f"{checkpoint_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'size': size, 'chunk_bytes': self.chunk_bytes, 'done': sorted(done)}, f)
+        os.replace(tmp_path, checkpoint_path)
@@ -0,0 +1,148 @@
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time; callers arriving meanwhile share its outcome."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """Return func(*args, **kwargs), or the result (or exception) of the same key's call in flight."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+        if not leader:
+            return call.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class SharedIterator:
+    """One iterator consumed by several readers: each item is produced once and replayed to every reader.
+
+    Whichever reader first needs the next item pulls it from the source, so no extra thread is
+    involved; the lock is not held meanwhile, so readers behind it keep replaying buffered
+    items. Readers that attach late start from the first item. Items are kept until the
+    SharedIterator itself is dropped.
+
+    If every attached reader stops early, the source is closed (a generator source sees
+    GeneratorExit), on_close is called and no reader can attach any more.
+    """
+
+    def __init__(self, iterable, on_close=None):
+        self._iterator = iter(iterable)
+        self._items = []
+        self._error = None
+        self._on_close = on_close
+        self._readers = 0
+        self._producing = False
+        self.done = False
+        self.closed = False
+        self._changed = threading.Condition()
+
+    def __iter__(self):
+        reader = self.attach()
+        if reader is None:
+            raise RuntimeError("SharedIterator was closed after all of its readers left")
+        return reader
+
+    def attach(self):
+        """Return a new reader starting from the first item, or None if the source was closed."""
+        with self._changed:
+            if self.closed:
+                return None
+            self._readers += 1
+        return _SharedIteratorReader(self)
+
+    def _next(self, index):
+        with self._changed:
+            while index == len(self._items) and not self.done and self._producing:
+                self._changed.wait()
+            if index < len(self._items):
+                return self._items[index]
+            if self._error is not None:
+                raise self._error
+            if self.done:
+                raise StopIteration
+            self._producing = True
+
+        try:
+            item = next(self._iterator)
+        except StopIteration:
+            self._finish()
+            raise
+        except BaseException as e:
+            self._finish(e)
+            raise
+        with self._changed:
+            self._producing = False
+            self._items.append(item)
+            self._changed.notify_all()
+        return item
+
+    def _finish(self, error=None):
+        with self._changed:
+            self._producing = False
+            self._error = error
+            self.done = True
+            self._changed.notify_all()
+
+    def _detach(self):
+        with self._changed:
+            self._readers -= 1
+            abandoned = self._readers == 0 and not self.done
+            if abandoned:
+                self.done = self.closed = True
+                self._changed.notify_all()
+        if abandoned:
+            close = getattr(self._iterator, 'close', None)
+            if close is not None:
+                close()
+            if self._on_close is not None:
+                self._on_close()
+
+
+class _SharedIteratorReader:
+    """One reader's position in a SharedIterator; detaches when exhausted, closed or dropped."""
+
+    def __init__(self, shared):
+        self._shared = shared
+        self._index = 0
+        self._attached = True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._attached:
+            raise StopIteration
+        try:
+            item = self._shared._next(self._index)
+        except BaseException:
+            self.close()
+            raise
+        self._index += 1
+        return item
+
+    def close(self):
+        if self._attached:
+            self._attached = False
+            self._shared._detach()
+
+    def __del__(self):
+        self.close()
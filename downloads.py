@@ -0,0 +1,592 @@
+import fcntl
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from moviepy.config import get_setting
+from pytube import YouTube, extract
+
+from chunked_download import ChunkedDownloader, DownloadProgress
+from coalescing import SingleFlight
+
+# Directory for precomputed artefacts that should not be served publicly
+CACHE_DIRECTORY = os.environ.get('CACHE_DIRECTORY', 'cache')
+DOWNLOAD_CACHE_DIRECTORY = os.path.join(CACHE_DIRECTORY, 'videos')
+
+# Total size of cached downloads before the least recently used ones are evicted
+DOWNLOAD_CACHE_MAX_BYTES = int(os.environ.get('DOWNLOAD_CACHE_MAX_BYTES', 5 * 1024 ** 3))
+
+# Leftovers of interrupted downloads (resumable .partial files and their checkpoints, temporary
+# files) are deleted once untouched for this many seconds; younger ones count towards the size
+DOWNLOAD_PARTIAL_MAX_AGE = float(os.environ.get('DOWNLOAD_PARTIAL_MAX_AGE', 24 * 3600))
+
+# Serve videos from this directory instead of YouTube (see LocalVideoSource)
+LOCAL_VIDEO_SOURCE = os.environ.get('LOCAL_VIDEO_SOURCE', '')
+
+# Stream selection policies. "analysis" feeds scene detection and CLIP, which downscale every
+# frame anyway, so it takes the smallest H.264 stream of at least min_height, with or without
+# audio. "export" is what scenes are cut from: the largest progressive (audio + video) stream
+# of at most max_height.
+StreamProfile = namedtuple('StreamProfile', ['name', 'needs_audio', 'min_height', 'max_height', 'prefer'])
+STREAM_PROFILES = {
+    'analysis': StreamProfile('analysis', needs_audio=False, min_height=int(os.environ.get('ANALYSIS_MIN_HEIGHT', 240)),
+                              max_height=int(os.environ.get('ANALYSIS_MAX_HEIGHT', 480)), prefer='lowest'),
+    'export': StreamProfile('export', needs_audio=True, min_height=0,
+                            max_height=int(os.environ.get('EXPORT_MAX_HEIGHT', 4320)), prefer='highest'),
+}
+DEFAULT_PROFILE = 'export'
+
+# Soundtrack-only downloads: the lowest bitrate AAC stream at or above MIN_AUDIO_KBPS
+AUDIO_STREAM_KEY = 'audio-mp4-smallest'
+MIN_AUDIO_KBPS = int(os.environ.get('MIN_AUDIO_KBPS', 96))
+
+
+def copy_audio(input_path, output_path, duration=None):
+    """Copy the first audio track of input_path (a file or URL) into an m4a file without re-encoding.
+
+    With a duration, ffmpeg stops reading once that much audio has been copied, so a remote
+    input is only fetched as far as needed.
+    """
+    command = [get_setting("FFMPEG_BINARY"), '-hide_banner', '-loglevel', 'error', '-y', '-i', input_path,
+               '-vn', '-map', '0:a:0', '-c:a', 'copy']
+    if duration is not None:
+        command += ['-t', f"{duration:.3f}"]
+    command += ['-f', 'ipod', output_path]
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg could not copy audio from {input_path}: {result.stderr.strip()}")
+
+
+# Seconds fetched before each segment so the stream copy can start at an earlier keyframe
+SEGMENT_PADDING_SECONDS = float(os.environ.get('SEGMENT_PADDING_SECONDS', 1.0))
+SEGMENT_DOWNLOAD_WORKERS = int(os.environ.get('SEGMENT_DOWNLOAD_WORKERS', 4))
+
+
+def copy_segment(input_path, output_path, start_seconds, end_seconds):
+    """Stream-copy [start_seconds, end_seconds) of input_path (a file or URL) into a Matroska file.
+
+    ffmpeg seeks the input with HTTP range requests, so only the bytes around the segment are
+    read. The copy starts at the keyframe before start_seconds and keeps the source timestamps;
+    returns the source time at which the written file starts.
+    """
+    # With -copyts the output's timestamps are the source's, so it is cut at the absolute end
+    # time; a -t duration would be measured from 0 and stop before the segment begins
+    command = [get_setting("FFMPEG_BINARY"), '-hide_banner', '-loglevel', 'error', '-y',
+               '-ss', f"{start_seconds:.3f}", '-i', input_path, '-to', f"{end_seconds:.3f}",
+               '-map', '0:v:0', '-map', '0:a?', '-c', 'copy', '-copyts', '-f', 'matroska', output_path]
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg could not copy {start_seconds:.3f}-{end_seconds:.3f}s from {input_path}: {result.stderr.strip()}")
+
+    probe = subprocess.run([get_setting("FFMPEG_BINARY"), '-hide_banner', '-i', output_path],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    # Raising keeps an empty segment out of the download cache
+    duration = re.search(r'Duration:\s*(\d+):(\d+):([0-9.]+)', probe.stderr)
+    if not duration or not int(duration.group(1)) * 3600 + int(duration.group(2)) * 60 + float(duration.group(3)):
+        raise RuntimeError(f"ffmpeg wrote no media for {start_seconds:.3f}-{end_seconds:.3f}s of {input_path}")
+    match = re.search(r'start:\s*(-?[0-9.]+)', probe.stderr)
+    return float(match.group(1)) if match else start_seconds
+
+
+chunked_downloader = ChunkedDownloader()
+
+
+def download_stream(media_url, destination_path, resume_path=None, progress=None):
+    """Download media_url to destination_path in parallel byte-range chunks.
+
+    With a resume_path the file is assembled there first, so the chunks of a failed attempt
+    are kept for the next one; a lock stops two workers resuming the same file at once.
+    """
+    if resume_path is None:
+        chunked_downloader.download(media_url, destination_path, progress)
+        return
+    lock_path = f"{resume_path}.lock"
+    with open(lock_path, 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # The holder deletes the lock file when done; a lock on a deleted file guards nothing
+            if os.fstat(lock.fileno()).st_ino != os.stat(lock_path).st_ino:
+                raise BlockingIOError
+        except (BlockingIOError, FileNotFoundError):
+            # Another worker is resuming this download; fetch a private copy instead of waiting
+            chunked_downloader.download(media_url, destination_path, progress)
+            return
+        try:
+            chunked_downloader.download(media_url, resume_path, progress)
+            os.replace(resume_path, destination_path)
+        finally:
+            # Removed while still held, so no other worker can be holding it
+            try:
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+
+
+def profile_stream_key(profile):
+    """Cache key for streams chosen by a profile; changing its bounds starts a new cache entry."""
+    return f"{profile.name}-{profile.min_height}-{profile.max_height}p"
+
+
+def stream_height(stream):
+    try:
+        return int(stream.resolution.rstrip('p'))
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+
+def select_stream(streams, profile):
+    """Pick the mp4 stream a StreamProfile asks for from a pytube StreamQuery, or None.
+
+    Streams within [min_height, max_height] are preferred; otherwise the closest one outside
+    the range is used.
+    """
+    if profile.needs_audio:
+        candidates = streams.filter(progressive=True, file_extension='mp4')
+    else:
+        # OpenCV reliably decodes H.264, not the AV1 variants YouTube also offers
+        candidates = [stream for stream in streams.filter(type='video', file_extension='mp4')
+                      if (stream.video_codec or '').startswith('avc1')]
+    candidates = sorted((stream for stream in candidates if stream_height(stream)), key=stream_height)
+    if not candidates:
+        return None
+
+    in_range = [stream for stream in candidates if profile.min_height <= stream_height(stream) <= profile.max_height]
+    if in_range:
+        return in_range[0] if profile.prefer == 'lowest' else in_range[-1]
+    above = [stream for stream in candidates if stream_height(stream) > profile.max_height]
+    return above[0] if above else candidates[-1]
+
+
+def audio_kbps(stream):
+    try:
+        return int(stream.abr.rstrip('kbps'))
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+
+class YouTubeSource:
+    """Downloads streams from YouTube with pytube."""
+
+    def video_id(self, url):
+        return extract.video_id(url)
+
+    def download(self, url, stream_key, destination_path, duration=None, resume_path=None, progress=None):
+        """Write the stream selected by stream_key to destination_path and return its metadata,
+        or return None if the video has no matching stream. duration trims audio streams;
+        resume_path keeps a partially downloaded video stream across attempts and progress
+        (a chunked_download.DownloadProgress) reports how much of it can already be read."""
+        yt = YouTube(url)
+        if stream_key == AUDIO_STREAM_KEY:
+            audio_streams = sorted(yt.streams.filter(only_audio=True, subtype='mp4'), key=audio_kbps)
+            adequate = [stream for stream in audio_streams if audio_kbps(stream) >= MIN_AUDIO_KBPS]
+            stream = adequate[0] if adequate else (audio_streams[-1] if audio_streams else None)
+            if not stream:
+                return None
+            copy_audio(stream.url, destination_path, duration)
+            return {'title': yt.title, 'itag': stream.itag, 'abr': stream.abr, 'mime_type': stream.mime_type, 'duration': duration}
+
+        profile = next((p for p in STREAM_PROFILES.values() if profile_stream_key(p) == stream_key), None)
+        if profile is None:
+            raise ValueError(f"Unknown stream key: {stream_key}")
+        stream = select_stream(yt.streams, profile)
+        if not stream:
+            return None
+        download_stream(stream.url, destination_path, resume_path, progress)
+        return {'title': yt.title, 'itag': stream.itag, 'resolution': stream.resolution, 'mime_type': stream.mime_type}
+
+    def stream_url(self, url, profile):
+        """Return (direct media URL, metadata) of the stream a profile selects, or None."""
+        yt = YouTube(url)
+        stream = select_stream(yt.streams, STREAM_PROFILES[profile])
+        if not stream:
+            return None
+        return stream.url, {'title': yt.title, 'itag': stream.itag, 'resolution': stream.resolution, 'mime_type': stream.mime_type}
+
+
+class LocalVideoSource:
+    """Stand-in for YouTube that serves <directory>/<video_id>.mp4, for offline development and tests.
+
+    directory may also be an http(s) base URL, e.g. a local range-capable HTTP server.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.is_remote = directory.startswith(('http://', 'https://'))
+
+    def video_id(self, url):
+        try:
+            return extract.video_id(url)
+        except Exception:
+            return os.path.splitext(os.path.basename(url))[0]
+
+    def source_path(self, url):
+        filename = f"{self.video_id(url)}.mp4"
+        if self.is_remote:
+            return f"{self.directory.rstrip('/')}/{filename}"
+        source_path = os.path.join(self.directory, filename)
+        return source_path if os.path.exists(source_path) else None
+
+    def download(self, url, stream_key, destination_path, duration=None, resume_path=None, progress=None):
+        source_path = self.source_path(url)
+        if source_path is None:
+            return None
+        if stream_key == AUDIO_STREAM_KEY:
+            copy_audio(source_path, destination_path, duration)
+            return {'title': os.path.basename(source_path), 'itag': None, 'abr': None, 'mime_type': 'audio/mp4', 'duration': duration}
+        if self.is_remote:
+            download_stream(source_path, destination_path, resume_path, progress)
+        else:
+            shutil.copyfile(source_path, destination_path)
+        return {'title': os.path.basename(source_path), 'itag': None, 'resolution': None, 'mime_type': 'video/mp4'}
+
+    def stream_url(self, url, profile):
+        source_path = self.source_path(url)
+        if source_path is None:
+            return None
+        return source_path, {'title': os.path.basename(source_path), 'itag': None, 'resolution': None, 'mime_type': 'video/mp4'}
+
+
+class DownloadCache:
+    """Content-addressed store of downloaded streams, keyed by video id and stream key.
+
+    Each entry is a media file plus a JSON sidecar holding its metadata and last access
+    time. Files are written under a temporary name and renamed into place, and the least
+    recently used entries are evicted once the cache grows past max_bytes. Concurrent misses
+    on the same entry download it once. Files left behind by interrupted downloads count
+    towards max_bytes and are deleted once older than partial_max_age seconds.
+    """
+
+    def __init__(self, directory=DOWNLOAD_CACHE_DIRECTORY, max_bytes=DOWNLOAD_CACHE_MAX_BYTES,
+                 partial_max_age=DOWNLOAD_PARTIAL_MAX_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.partial_max_age = partial_max_age
+        self._lock = threading.Lock()
+        self._downloads = SingleFlight()
+
+    def entry_path(self, video_id, stream_key, extension='mp4'):
+        return os.path.join(self.directory, video_id, f"{stream_key}.{extension}")
+
+    def sidecar_path(self, media_path):
+        return f"{media_path}.json"
+
+    def get(self, video_id, stream_key, extension='mp4'):
+        """Return the cached path for the entry, or None, refreshing its last access time on a hit."""
+        media_path = self.entry_path(video_id, stream_key, extension)
+        metadata = self._read_sidecar(media_path)
+        if metadata is None or not os.path.exists(media_path):
+            return None
+        metadata['last_access'] = time.time()
+        self._write_sidecar(media_path, metadata)
+        return media_path
+
+    def fetch(self, video_id, stream_key, download, extension='mp4'):
+        """Return the cached path for the entry, calling download(tmp_path) -> metadata on a miss.
+
+        download must write the stream to tmp_path and return a metadata dict, or return None
+        when nothing could be downloaded, in which case fetch returns None too.
+        """
+        media_path = self.get(video_id, stream_key, extension)
+        if media_path:
+            return media_path
+        return self._downloads.do(self.entry_path(video_id, stream_key, extension), self._download, video_id, stream_key, download, extension)
+
+    def _download(self, video_id, stream_key, download, extension):
+        # A download that finished after the check in fetch may have written the entry already
+        media_path = self.get(video_id, stream_key, extension)
+        if media_path:
+            return media_path
+
+        media_path = self.entry_path(video_id, stream_key, extension)
+        os.makedirs(os.path.dirname(media_path), exist_ok=True)
+        tmp_path = f"{media_path}.{os.getpid()}.{threading.get_ident()}.part"
+        try:
+            metadata = download(tmp_path)
+            if metadata is None:
+                return None
+            os.replace(tmp_path, media_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        now = time.time()
+        metadata = dict(metadata, video_id=video_id, stream_key=stream_key, size=os.path.getsize(media_path), created=now, last_access=now)
+        self._write_sidecar(media_path, metadata)
+        self.evict(keep=media_path)
+        return media_path
+
+    def entries(self):
+        """Return (media_path, metadata) for every complete entry in the cache."""
+        found = []
+        if not os.path.isdir(self.directory):
+            return found
+        for video_id in os.listdir(self.directory):
+            video_directory = os.path.join(self.directory, video_id)
+            if not os.path.isdir(video_directory):
+                continue
+            for filename in os.listdir(video_directory):
+                if not filename.endswith('.json'):
+                    continue
+                media_path = os.path.join(video_directory, filename[:-len('.json')])
+                metadata = self._read_sidecar(media_path)
+                if metadata is not None and os.path.exists(media_path):
+                    found.append((media_path, metadata))
+        return found
+
+    def leftovers(self, entries=None):
+        """Return (path, size, mtime) for every file in the cache that is not part of a complete entry."""
+        if entries is None:
+            entries = self.entries()
+        entry_files = {path for media_path, _ in entries for path in (media_path, self.sidecar_path(media_path))}
+        found = []
+        if not os.path.isdir(self.directory):
+            return found
+        for video_id in os.listdir(self.directory):
+            video_directory = os.path.join(self.directory, video_id)
+            if not os.path.isdir(video_directory):
+                continue
+            for filename in os.listdir(video_directory):
+                path = os.path.join(video_directory, filename)
+                if path in entry_files:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue  # Finished or cleaned up meanwhile
+                found.append((path, stat.st_size, stat.st_mtime))
+        return found
+
+    def evict(self, keep=None):
+        """Remove stale leftovers, then least recently used entries until the cache fits in max_bytes."""
+        with self._lock:
+            entries = sorted(self.entries(), key=lambda entry: entry[1].get('last_access', 0))
+            total_bytes = sum(metadata.get('size', 0) for _, metadata in entries)
+            now = time.time()
+            for path, size, modified in self.leftovers(entries):
+                if now - modified <= self.partial_max_age:
+                    total_bytes += size  # Possibly still being written
+                    continue
+                logging.info(f"Removing stale partial download {path}")
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            for media_path, metadata in entries:
+                if total_bytes <= self.max_bytes:
+                    break
+                if media_path == keep:
+                    continue
+                logging.info(f"Evicting {media_path} from the download cache")
+                for path in (media_path, self.sidecar_path(media_path)):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                total_bytes -= metadata.get('size', 0)
+
+    def metadata(self, media_path):
+        return self._read_sidecar(media_path)
+
+    def _read_sidecar(self, media_path):
+        try:
+            with open(self.sidecar_path(media_path)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_sidecar(self, media_path, metadata):
+        sidecar_path = self.sidecar_path(media_path)
+        tmp_path = f"{sidecar_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(metadata, f)
+        os.replace(tmp_path, sidecar_path)
+
+
+video_source = LocalVideoSource(LOCAL_VIDEO_SOURCE) if LOCAL_VIDEO_SOURCE else YouTubeSource()
+download_cache = DownloadCache()
+
+
+def fetch_video(url, profile=DEFAULT_PROFILE, source=None, cache=None, progress=None):
+    """Return a local path for the video at url in the given stream profile, downloading it only on a cache miss."""
+    source = source or video_source
+    cache = cache or download_cache
+    stream_key = profile_stream_key(STREAM_PROFILES[profile])
+    video_id = source.video_id(url)
+    # A stable partial path, unlike fetch's per-attempt tmp_path, lets a failed download resume
+    resume_path = f"{cache.entry_path(video_id, stream_key)}.partial"
+    return cache.fetch(video_id, stream_key, lambda tmp_path: source.download(url, stream_key, tmp_path, resume_path=resume_path, progress=progress))
+
+
+class ProgressiveDownload:
+    """fetch_video running in the background, readable while the file is still arriving.
+
+    Readers follow the contiguous prefix written so far through iter_bytes() or pipe(). The
+    cached path is available from result() once the download is complete; a failed download
+    makes readers stop early and result() raise.
+    """
+
+    def __init__(self, url, profile=DEFAULT_PROFILE, source=None, cache=None):
+        self.key = ((source or video_source).video_id(url), profile)
+        self.progress = DownloadProgress()
+        self._path = None
+        self._thread = threading.Thread(target=self._run, args=(url, profile, source, cache), daemon=True)
+        self._thread.start()
+
+    def _run(self, url, profile, source, cache):
+        try:
+            self._path = fetch_video(url, profile, source, cache, progress=self.progress)
+            if self._path is None:
+                raise RuntimeError(f"No {profile} stream available for {url}")
+            self.progress.finish(self._path)
+        except Exception as e:
+            self.progress.fail(e)
+
+    def result(self):
+        self._thread.join()
+        if self.progress.error is not None:
+            raise self.progress.error
+        return self._path
+
+    def iter_bytes(self, block_bytes=1024 ** 2):
+        offset = 0
+        f = None
+        try:
+            while True:
+                path, available, done = self.progress.wait(offset)
+                if available > offset:
+                    if f is None:
+                        # Unbuffered, so bytes read ahead past the download head are never served stale
+                        f = open(path, 'rb', buffering=0)
+                    f.seek(offset)
+                    data = f.read(min(block_bytes, available - offset))
+                    offset += len(data)
+                    yield data
+                elif done:
+                    return
+        finally:
+            if f is not None:
+                f.close()
+
+    @contextmanager
+    def pipe(self):
+        """Yield the path of a FIFO that delivers the video's bytes as they are downloaded."""
+        directory = tempfile.mkdtemp(prefix='progressive-')
+        fifo_path = os.path.join(directory, 'video')
+        os.mkfifo(fifo_path)
+
+        def feed():
+            try:
+                with open(fifo_path, 'wb') as fifo:
+                    for data in self.iter_bytes():
+                        fifo.write(data)
+            except BrokenPipeError:
+                pass  # The reader stopped early
+            except Exception as e:
+                logging.warning(f"Progressive read of {fifo_path} stopped: {e}")
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            yield fifo_path
+        finally:
+            # Open and close the read end so a feeder still waiting for a reader is released
+            os.close(os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK))
+            feeder.join(timeout=1)
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+_progressive_downloads = {}
+_progressive_downloads_lock = threading.Lock()
+
+
+def start_progressive_download(url, profile=DEFAULT_PROFILE, source=None, cache=None):
+    """Return the ProgressiveDownload of this video and profile, joining one that is still running."""
+    key = ((source or video_source).video_id(url), profile)
+    with _progressive_downloads_lock:
+        for finished_key in [k for k, download in _progressive_downloads.items() if download.progress.done]:
+            del _progressive_downloads[finished_key]
+        download = _progressive_downloads.get(key)
+        if download is None:
+            download = _progressive_downloads[key] = ProgressiveDownload(url, profile, source, cache)
+        return download
+
+
+def fetch_audio(url, duration=None, source=None, cache=None):
+    """Return a local m4a path holding the soundtrack of the video at url.
+
+    With a duration the audio is trimmed while it is downloaded (rounded up to whole seconds so
+    similar requests share a cache entry); if the full soundtrack is already cached it is
+    trimmed locally instead.
+    """
+    source = source or video_source
+    cache = cache or download_cache
+    video_id = source.video_id(url)
+    if duration is None:
+        return cache.fetch(video_id, AUDIO_STREAM_KEY, lambda tmp_path: source.download(url, AUDIO_STREAM_KEY, tmp_path), extension='m4a')
+
+    duration = math.ceil(duration)
+    full_audio_path = cache.get(video_id, AUDIO_STREAM_KEY, extension='m4a')
+
+    def download(tmp_path):
+        if full_audio_path:
+            copy_audio(full_audio_path, tmp_path, duration)
+            return {'trimmed_from': os.path.basename(full_audio_path), 'duration': duration}
+        return source.download(url, AUDIO_STREAM_KEY, tmp_path, duration)
+
+    return cache.fetch(video_id, f"{AUDIO_STREAM_KEY}-{duration}s", download, extension='m4a')
+
+
+def fetch_segments(url, intervals, profile=DEFAULT_PROFILE, source=None, cache=None, max_workers=SEGMENT_DOWNLOAD_WORKERS):
+    """Download only the (start_seconds, end_seconds) intervals of a video's stream.
+
+    Returns one (path, start_in_file, end_in_file) tuple per interval, in order, ready for
+    render_segments, or None if the stream could not be resolved. Segments are cached
+    individually, so re-exporting the same scenes needs no network at all.
+    """
+    source = source or video_source
+    cache = cache or download_cache
+    video_id = source.video_id(url)
+    stream_key = profile_stream_key(STREAM_PROFILES[profile])
+    resolved = []
+    resolve_lock = threading.Lock()
+
+    def stream_url():
+        # Resolve the media URL at most once, and only if some segment is not cached yet
+        with resolve_lock:
+            if not resolved:
+                resolved.append(source.stream_url(url, profile))
+            return resolved[0]
+
+    def fetch_segment(interval):
+        start_seconds, end_seconds = interval
+        segment_key = f"{stream_key}-segment-{start_seconds:.3f}-{end_seconds:.3f}"
+
+        def download(tmp_path):
+            stream = stream_url()
+            if stream is None:
+                return None
+            media_url, metadata = stream
+            file_start = copy_segment(media_url, tmp_path, max(0.0, start_seconds - SEGMENT_PADDING_SECONDS), end_seconds)
+            return dict(metadata, segment_start=start_seconds, segment_end=end_seconds, file_start=file_start)
+
+        segment_path = cache.fetch(video_id, segment_key, download, extension='mkv')
+        if segment_path is None:
+            return None
+        file_start = cache.metadata(segment_path)['file_start']
+        return segment_path, start_seconds - file_start, end_seconds - file_start
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(intervals)))) as executor:
+        segments = list(executor.map(fetch_segment, intervals))
+    if any(segment is None for segment in segments):
+        return None
+    return segments
@@ -0,0 +1,166 @@
+import importlib
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of pipeline runs executed concurrently by the in-process backend
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+
+# Finished jobs kept in memory before the oldest ones are forgotten
+MAX_RETAINED_JOBS = int(os.environ.get('MAX_RETAINED_JOBS', 200))
+
+# Optional "module:attribute" path of a factory returning an alternative backend
+JOB_BACKEND = os.environ.get('JOB_BACKEND', '')
+
+
+class Job:
+    """Status, per-stage progress and result of one background pipeline run."""
+
+    def __init__(self, job_id, stages=()):
+        self.id = job_id
+        self.status = 'queued'
+        self.stages = OrderedDict((stage, {'status': 'pending', 'progress': 0.0}) for stage in stages)
+        self.result = None
+        self.error = None
+        self.events = []
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def update_stage(self, stage, progress=None, status='running'):
+        with self._lock:
+            stage_info = self.stages.setdefault(stage, {'status': 'pending', 'progress': 0.0})
+            stage_info['status'] = status
+            if progress is not None:
+                stage_info['progress'] = round(min(max(progress, 0.0), 1.0), 4)
+            if status == 'done':
+                stage_info['progress'] = 1.0
+            self.updated_at = time.time()
+
+    def publish(self, event, data):
+        """Record a partial result for clients following the job through wait_for_events."""
+        with self._changed:
+            self.events.append((event, data))
+            self.updated_at = time.time()
+            self._changed.notify_all()
+
+    def wait_for_events(self, cursor, timeout=None):
+        """Block until there are events past cursor or the job is done; return (events, done)."""
+        with self._changed:
+            self._changed.wait_for(lambda: len(self.events) > cursor or self.done, timeout)
+            return self.events[cursor:], self.done
+
+    def finish(self, result):
+        with self._changed:
+            self.status = 'finished'
+            self.result = result
+            self.updated_at = time.time()
+            self._changed.notify_all()
+
+    def fail(self, error):
+        with self._changed:
+            self.status = 'failed'
+            self.error = str(error)
+            for stage_info in self.stages.values():
+                if stage_info['status'] == 'running':
+                    stage_info['status'] = 'failed'
+            self.updated_at = time.time()
+            self._changed.notify_all()
+
+    @property
+    def done(self):
+        return self.status in ('finished', 'failed')
+
+    def to_dict(self):
+        with self._lock:
+            job_dict = {
+                'job_id': self.id,
+                'status': self.status,
+                'stages': {stage: dict(info) for stage, info in self.stages.items()},
+                'created_at': self.created_at,
+                'updated_at': self.updated_at,
+            }
+            if self.result is not None:
+                job_dict['result'] = self.result
+            if self.error is not None:
+                job_dict['error'] = self.error
+            return job_dict
+
+
+class InProcessJobBackend:
+    """Runs jobs on a local thread pool and keeps their state in memory.
+
+    Submitting with a key that matches a job still queued or running returns that job instead
+    of starting another. Alternative backends only need submit(func, *args, stages=(), key=None,
+    **kwargs) -> Job and get(job_id) -> Job or None; they may ignore key.
+    """
+
+    def __init__(self, max_workers=JOB_WORKERS, max_retained_jobs=MAX_RETAINED_JOBS):
+        self.max_retained_jobs = max_retained_jobs
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._jobs = OrderedDict()
+        self._active_jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, stages=(), key=None, **kwargs):
+        """Queue func(job, *args, **kwargs); its return value becomes the job result."""
+        with self._lock:
+            active_job = self._active_jobs.get(key) if key is not None else None
+            if active_job is not None and not active_job.done:
+                return active_job
+            job = Job(uuid.uuid4().hex, stages)
+            self._jobs[job.id] = job
+            if key is not None:
+                self._active_jobs[key] = job
+            self._forget_old_jobs()
+        self._executor.submit(self._run, job, func, args, kwargs, key)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job, func, args, kwargs, key=None):
+        job.status = 'running'
+        try:
+            job.finish(func(job, *args, **kwargs))
+        except Exception as e:
+            logging.exception(f"Job {job.id} failed")
+            job.fail(e)
+        finally:
+            with self._lock:
+                if key is not None and self._active_jobs.get(key) is job:
+                    del self._active_jobs[key]
+
+    def _forget_old_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.done]
+        for job_id in finished[:max(0, len(self._jobs) - self.max_retained_jobs)]:
+            del self._jobs[job_id]
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """Return the configured job backend, creating it on first use."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if JOB_BACKEND:
+                module_name, _, attribute = JOB_BACKEND.partition(':')
+                _backend = getattr(importlib.import_module(module_name), attribute)()
+            else:
+                _backend = InProcessJobBackend()
+        return _backend
+
+
+def set_backend(backend):
+    global _backend
+    with _backend_lock:
+        _backend = backend
@@ -0,0 +1,87 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from downloads import CACHE_DIRECTORY
+from lru import LRUCache
+
+# Backend holding processed-video results: "memory" (per worker) or "sqlite" (shared on one host)
+RESULT_STORE = os.environ.get('RESULT_STORE', 'memory')
+RESULT_STORE_PATH = os.environ.get('RESULT_STORE_PATH', os.path.join(CACHE_DIRECTORY, 'results.sqlite3'))
+
+# Number of job results kept before the least recently used ones are dropped
+RESULT_STORE_MAX_ENTRIES = int(os.environ.get('RESULT_STORE_MAX_ENTRIES', 500))
+
+
+class MemoryResultStore:
+    """Job results in a bounded in-process LRU. Only visible to the worker that stored them."""
+
+    def __init__(self, max_entries=RESULT_STORE_MAX_ENTRIES):
+        self._results = LRUCache(max_entries)
+
+    def get(self, token):
+        return self._results.get(token)
+
+    def put(self, token, result):
+        self._results.put(token, result)
+
+
+class SQLiteResultStore:
+    """Job results in a SQLite file, shared by every worker process on the same host."""
+
+    def __init__(self, path=RESULT_STORE_PATH, max_entries=RESULT_STORE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS results (token TEXT PRIMARY KEY, data TEXT NOT NULL, accessed_at REAL NOT NULL)')
+
+    def _connection(self):
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = sqlite3.connect(self.path, timeout=30)
+            self._local.connection.execute('PRAGMA journal_mode=WAL')
+        return self._local.connection
+
+    def get(self, token):
+        with self._connection() as connection:
+            row = connection.execute('SELECT data FROM results WHERE token = ?', (token,)).fetchone()
+            if row is None:
+                return None
+            connection.execute('UPDATE results SET accessed_at = ? WHERE token = ?', (time.time(), token))
+        return json.loads(row[0])
+
+    def put(self, token, result):
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO results (token, data, accessed_at) VALUES (?, ?, ?)',
+                               (token, json.dumps(result), time.time()))
+            connection.execute('DELETE FROM results WHERE token NOT IN (SELECT token FROM results ORDER BY accessed_at DESC LIMIT ?)',
+                               (self.max_entries,))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Return the configured result store, creating it on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            if RESULT_STORE == 'sqlite':
+                _store = SQLiteResultStore()
+            elif RESULT_STORE == 'memory':
+                _store = MemoryResultStore()
+            else:
+                raise ValueError(f"Unknown result store: {RESULT_STORE}")
+        return _store
+
+
+def set_store(store):
+    global _store
+    with _store_lock:
+        _store = store
@@ -0,0 +1,129 @@
+import math
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+
+# Keep caches written by the modules under test out of the working tree
+os.environ.setdefault('CACHE_DIRECTORY', tempfile.mkdtemp(prefix='test-cache-'))
+
+
+class StubCLIP:
+    """Stands in for a CLIP model: deterministic 16-dimensional features and no weights to download."""
+
+    def __init__(self, torch):
+        self.torch = torch
+        self.dtype = torch.float32
+        self.logit_scale = torch.tensor(math.log(100.0))
+        self.projection = torch.randn(3, 16, generator=torch.Generator().manual_seed(0))
+
+    def encode_text(self, tokens):
+        return self.torch.stack([self.torch.randn(16, generator=self.torch.Generator().manual_seed(int(row.sum()))) for row in tokens])
+
+    def encode_image(self, images):
+        return images.mean(dim=(2, 3)) @ self.projection
+
+
+def stub_preprocess(torch, image):
+    return torch.from_numpy(np.asarray(image.convert('RGB').resize((8, 8)), dtype=np.float32) / 255).permute(2, 0, 1)
+
+
+@pytest.fixture(scope='session')
+def vp():
+    """video_processing_refactored with clip.load stubbed, so importing it needs no model weights.
+
+    Tests that score frames replace encode_text_features and score_image_features themselves.
+    """
+    try:
+        import clip
+        import torch
+    except ImportError as e:
+        pytest.skip(f"CLIP is not installed: {e}")
+    load = clip.load
+    clip.load = lambda name, device='cpu': (StubCLIP(torch), partial(stub_preprocess, torch))
+    try:
+        import video_processing_refactored
+    finally:
+        clip.load = load
+    return video_processing_refactored
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Serves a directory over keep-alive HTTP, answering single byte-range requests with 206.
+
+    While server.failures is positive, each range request not starting at byte 0 sends only
+    part of its body and drops the connection, as a flaky network would. Those requests are
+    also answered server.delay seconds late, so a download can be observed while it runs.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        # A small send buffer keeps the kernel from queueing much more than the client reads
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16 * 1024)
+
+    def do_GET(self):
+        try:
+            with open(self.translate_path(self.path), 'rb') as f:
+                data = f.read()
+        except OSError:
+            self.send_error(404)
+            return
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+            self.server.ranges.append((start, end))
+            if start > 0:
+                time.sleep(self.server.delay)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+            body = data[start:end + 1]
+        else:
+            self.send_response(200)
+            body = data
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if match and start > 0 and self.server.failures > 0:
+            self.server.failures -= 1
+            body = body[:len(body) // 2]
+            self.close_connection = True
+        # Written in blocks, so bytes_sent stops growing once a client hangs up mid-body
+        try:
+            for offset in range(0, len(body), 64 * 1024):
+                block = body[offset:offset + 64 * 1024]
+                self.wfile.write(block)
+                self.server.bytes_sent += len(block)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    """A range-capable HTTP server for server.directory at server.url.
+
+    server.ranges lists the ranges requested and server.bytes_sent counts the body bytes sent.
+    """
+    directory = tmp_path / 'served'
+    directory.mkdir()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(RangeRequestHandler, directory=str(directory)))
+    server.directory, server.url = directory, f'http://127.0.0.1:{server.server_address[1]}'
+    server.ranges, server.failures, server.delay, server.bytes_sent = [], 0, 0, 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+from coalescing import SharedIterator
+
+
+class Source:
+    """A generator source that records what was produced and whether it was closed."""
+
+    def __init__(self, count, gate=None):
+        self.produced = []
+        self.closed = False
+        self.gate = gate
+        self.iterator = self._generate(count)
+
+    def _generate(self, count):
+        try:
+            for item in range(count):
+                if self.gate is not None and item == 2:
+                    self.gate.wait(5)
+                self.produced.append(item)
+                yield item
+        except GeneratorExit:
+            self.closed = True
+            raise
+
+
+def test_items_are_produced_once_and_replayed_to_late_readers():
+    source = Source(4)
+    shared = SharedIterator(source.iterator)
+    first = iter(shared)
+    assert [next(first), next(first)] == [0, 1]
+    second = iter(shared)
+    assert list(second) == [0, 1, 2, 3]
+    assert list(first) == [2, 3]
+    assert source.produced == [0, 1, 2, 3]
+    assert shared.done and not source.closed and not shared.closed
+
+
+def test_source_errors_reach_every_reader():
+    def failing():
+        yield 1
+        raise ValueError('broken')
+
+    shared = SharedIterator(failing())
+    first, second = iter(shared), iter(shared)
+    with pytest.raises(ValueError):
+        list(first)
+    assert next(second) == 1
+    with pytest.raises(ValueError):
+        next(second)
+
+
+def test_source_is_closed_once_the_last_reader_leaves_early():
+    source = Source(10)
+    closed = []
+    shared = SharedIterator(source.iterator, on_close=lambda: closed.append(True))
+    first, second = iter(shared), iter(shared)
+    next(first)
+    next(second)
+
+    first.close()
+    assert not source.closed and list(second) == list(range(1, 10))
+
+    source = Source(10)
+    shared = SharedIterator(source.iterator, on_close=lambda: closed.append(True))
+    reader = iter(shared)
+    next(reader)
+    del reader  # Dropping a reader counts as leaving
+    assert source.closed and shared.closed and closed == [True]
+    assert shared.attach() is None
+    with pytest.raises(RuntimeError):
+        iter(shared)
+
+
+def test_readers_replay_buffered_items_while_another_produces():
+    gate = threading.Event()
+    source = Source(4, gate)
+    shared = SharedIterator(source.iterator)
+    first, second = iter(shared), iter(shared)
+    assert [next(first), next(first)] == [0, 1]
+
+    producing = threading.Thread(target=lambda: next(first))
+    producing.start()  # Blocks inside the source until the gate opens
+    try:
+        assert [next(second), next(second)] == [0, 1]
+        assert source.produced == [0, 1]  # Replayed without waiting for item 2
+    finally:
+        gate.set()
+        producing.join()
+    assert list(second) == [2, 3] and source.produced == [0, 1, 2, 3]
+
@@ -0,0 +1,254 @@
+import json
+import os
+import subprocess
+import time
+
+import numpy as np
+import pytest
+
+downloads = pytest.importorskip('downloads')
+from chunked_download import ChunkedDownloader
+
+
+@pytest.fixture
+def videos(tmp_path):
+    directory = tmp_path / 'videos'
+    directory.mkdir()
+    for video_id, size in (('first', 1000), ('second', 1500), ('third', 800)):
+        (directory / f'{video_id}.mp4').write_bytes(os.urandom(size))
+    return directory
+
+
+@pytest.fixture
+def source(videos):
+    return downloads.LocalVideoSource(str(videos))
+
+
+def test_fetch_video_downloads_once_then_serves_the_cache(tmp_path, videos, source):
+    cache = downloads.DownloadCache(str(tmp_path / 'cache'), max_bytes=10 ** 6)
+
+    path = downloads.fetch_video('first.mp4', 'analysis', source=source, cache=cache)
+    assert open(path, 'rb').read() == (videos / 'first.mp4').read_bytes()
+    metadata = cache.metadata(path)
+    assert metadata['video_id'] == 'first' and metadata['size'] == 1000
+
+    (videos / 'first.mp4').unlink()  # A second fetch must not touch the source
+    assert downloads.fetch_video('first.mp4', 'analysis', source=source, cache=cache) == path
+
+
+def test_fetch_video_returns_none_for_unknown_videos(tmp_path, source):
+    cache = downloads.DownloadCache(str(tmp_path / 'cache'))
+    assert downloads.fetch_video('missing.mp4', source=source, cache=cache) is None
+    assert cache.entries() == []
+
+
+def test_profiles_are_cached_separately(tmp_path, source):
+    cache = downloads.DownloadCache(str(tmp_path / 'cache'))
+    analysis = downloads.fetch_video('first.mp4', 'analysis', source=source, cache=cache)
+    export = downloads.fetch_video('first.mp4', 'export', source=source, cache=cache)
+    assert analysis != export
+    assert len(cache.entries()) == 2
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, source):
+    cache = downloads.DownloadCache(str(tmp_path / 'cache'), max_bytes=2600)
+
+    first = downloads.fetch_video('first.mp4', source=source, cache=cache)
+    time.sleep(0.01)
+    second = downloads.fetch_video('second.mp4', source=source, cache=cache)
+    time.sleep(0.01)
+    assert cache.get('first', downloads.profile_stream_key(downloads.STREAM_PROFILES[downloads.DEFAULT_PROFILE])) == first
+    time.sleep(0.01)
+    third = downloads.fetch_video('third.mp4', source=source, cache=cache)
+
+    # 3300 bytes do not fit; "second" is the least recently used entry
+    assert not os.path.exists(second) and not os.path.exists(cache.sidecar_path(second))
+    assert os.path.exists(first) and os.path.exists(third)
+    assert sorted(metadata['video_id'] for _, metadata in cache.entries()) == ['first', 'third']
+
+
+def ffmpeg(*args):
+    return subprocess.run([downloads.get_setting("FFMPEG_BINARY"), '-hide_banner', '-loglevel', 'error', *args],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True).stdout
+
+
+def frame_at(path, seconds):
+    """The decoded RGB frame of path shown at seconds into the file."""
+    return np.frombuffer(ffmpeg('-ss', f'{seconds:.3f}', '-i', str(path), '-frames:v', '1', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-'), np.uint8)
+
+
+def test_fetch_segments_cuts_intervals_from_a_remote_stream(tmp_path, http_server):
+    directory = http_server.directory
+    # 10 fps with a keyframe every 2 s, so the 35.0 s segment starts copying from the keyframe at 34.0 s
+    ffmpeg('-f', 'lavfi', '-i', 'testsrc=duration=120:size=640x360:rate=10', '-f', 'lavfi', '-i', 'sine=duration=120',
+           '-c:v', 'libx264', '-g', '20', '-c:a', 'aac', '-shortest', str(directory / 'clip.mp4'))
+    source = downloads.LocalVideoSource(http_server.url)
+    cache = downloads.DownloadCache(str(tmp_path / 'cache'))
+
+    segments = downloads.fetch_segments('clip.mp4', [(35.0, 37.0), (0.0, 1.0)], source=source, cache=cache)
+
+    # ffmpeg seeks with range requests, so only the bytes around the segments are transferred
+    assert http_server.bytes_sent < (directory / 'clip.mp4').stat().st_size / 2
+    (path, start, end), (first_path, first_start, first_end) = segments
+    assert 0 < start < end and end - start == pytest.approx(2.0)
+    assert first_start == pytest.approx(0.0, abs=0.05) and first_end == pytest.approx(1.0, abs=0.05)
+    # The frame half way between two source frames must be the same in the segment and the source
+    for source_seconds, file_seconds in ((35.05, start + 0.05), (36.95, end - 0.05)):
+        assert np.array_equal(frame_at(path, file_seconds), frame_at(directory / 'clip.mp4', source_seconds))
+
+    (directory / 'clip.mp4').unlink()  # Segments are served from the cache from now on
+    assert downloads.fetch_segments('clip.mp4', [(35.0, 37.0)], source=source, cache=cache) == [(path, start, end)]
+
+
+def test_chunked_download_resumes_after_a_failed_chunk(tmp_path, http_server):
+    data = os.urandom(10 * 1000 + 123)
+    (http_server.directory / 'video.mp4').write_bytes(data)
+    url, path = f'{http_server.url}/video.mp4', str(tmp_path / 'video.mp4')
+    downloader = ChunkedDownloader(chunk_bytes=1000, max_workers=1, retries=0)
+
+    http_server.failures = 1  # Chunk 1 is cut short
+    with pytest.raises(Exception):
+        downloader.download(url, path)
+    with open(downloader.checkpoint_path(path)) as f:
+        done = set(json.load(f)['done'])
+    assert 0 in done and 1 not in done
+
+    http_server.ranges.clear()
+    downloader.download(url, path)
+    assert open(path, 'rb').read() == data
+    assert not os.path.exists(downloader.checkpoint_path(path))
+    # Besides the probe, only the chunks missing after the failure were requested again
+    missing = [(index * 1000, min(index * 1000 + 999, len(data) - 1)) for index in range(11) if index not in done]
+    assert http_server.ranges[0] == (0, 0) and sorted(http_server.ranges[1:]) == missing
+
+
+@pytest.fixture
+def remote_source(monkeypatch, http_server):
+    # Small chunks and no retries, so a single dropped connection fails the download
+    monkeypatch.setattr(downloads, 'chunked_downloader', ChunkedDownloader(chunk_bytes=1000, max_workers=2, retries=0))
+    return downloads.LocalVideoSource(http_server.url)
+
+
+def test_failed_downloads_resume_from_the_partial_file(tmp_path, http_server, remote_source):
+    data = os.urandom(5000)
+    (http_server.directory / 'first.mp4').write_bytes(data)
+    cache = downloads.DownloadCache(str(tmp_path / 'cache'))
+
+    http_server.failures = 1
+    with pytest.raises(Exception):
+        downloads.fetch_video('first.mp4', source=remote_source, cache=cache)
+    leftovers = sorted(os.path.basename(path) for path, _, _ in cache.leftovers())
+    assert [name.split('.', 1)[1] for name in leftovers] == ['mp4.partial', 'mp4.partial.chunks']
+
+    http_server.ranges.clear()
+    path = downloads.fetch_video('first.mp4', source=remote_source, cache=cache)
+    assert open(path, 'rb').read() == data
+    assert (0, 999) not in http_server.ranges
+    assert cache.leftovers() == []  # Neither the partial file, its checkpoint nor the lock is left
+
+
+def test_eviction_counts_partial_downloads_and_removes_stale_ones(tmp_path, source):
+    cache = downloads.DownloadCache(str(tmp_path / 'cache'), max_bytes=2600, partial_max_age=3600)
+    first = downloads.fetch_video('first.mp4', source=source, cache=cache)
+    time.sleep(0.01)
+    second = downloads.fetch_video('second.mp4', source=source, cache=cache)
+
+    stale = tmp_path / 'cache' / 'third' / 'export.partial'
+    stale.parent.mkdir()
+    stale.write_bytes(os.urandom(5000))
+    os.utime(stale, (time.time() - 7200, time.time() - 7200))
+    fresh = tmp_path / 'cache' / 'third' / 'analysis.partial'
+    fresh.write_bytes(os.urandom(200))
+
+    cache.evict()
+    # The stale partial is gone; the fresh one stays and pushes 2700 bytes past the limit
+    assert not stale.exists() and fresh.exists()
+    assert not os.path.exists(first) and os.path.exists(second)
+
+
+def test_progressive_download_is_readable_while_it_runs(tmp_path, http_server, remote_source):
+    data = os.urandom(8000)
+    (http_server.directory / 'first.mp4').write_bytes(data)
+    http_server.delay = 0.05
+    download = downloads.ProgressiveDownload('first.mp4', source=remote_source, cache=downloads.DownloadCache(str(tmp_path / 'cache')))
+
+    blocks = []
+    for block in download.iter_bytes(block_bytes=1500):
+        blocks.append((block, download.progress.done))
+    assert b''.join(block for block, _ in blocks) == data
+    assert not blocks[0][1]  # The first bytes were read before the download finished
+    assert open(download.result(), 'rb').read() == data
+
+
+def test_progressive_download_pipe_delivers_the_whole_file(tmp_path, http_server, remote_source):
+    data = os.urandom(5000)
+    (http_server.directory / 'first.mp4').write_bytes(data)
+    download = downloads.ProgressiveDownload('first.mp4', source=remote_source, cache=downloads.DownloadCache(str(tmp_path / 'cache')))
+    with download.pipe() as fifo_path:
+        with open(fifo_path, 'rb') as fifo:
+            assert fifo.read() == data
+    assert not os.path.exists(fifo_path)
+
+
+def test_failed_progressive_downloads_reach_readers(tmp_path, http_server, remote_source):
+    download = downloads.ProgressiveDownload('missing.mp4', source=remote_source, cache=downloads.DownloadCache(str(tmp_path / 'cache')))
+    with pytest.raises(Exception):
+        list(download.iter_bytes())
+    with pytest.raises(Exception):
+        download.result()
+    assert download.progress.done
+
+
+class FakeStream:
+    def __init__(self, resolution, video_codec='avc1.4d401e', progressive=False, extension='mp4'):
+        self.resolution = resolution
+        self.video_codec = video_codec
+        self.is_progressive = progressive
+        self.subtype = extension
+
+    def __repr__(self):
+        return f"FakeStream({self.resolution}, {self.video_codec}, progressive={self.is_progressive})"
+
+
+class FakeStreamQuery:
+    """The part of pytube's StreamQuery that select_stream uses."""
+
+    def __init__(self, streams):
+        self.streams = streams
+
+    def filter(self, progressive=None, file_extension=None, type=None):
+        return [stream for stream in self.streams
+                if (progressive is None or stream.is_progressive == progressive)
+                and (file_extension is None or stream.subtype == file_extension)
+                and (type is None or type == 'video')]
+
+
+def test_analysis_streams_are_the_lowest_h264_stream_in_range():
+    streams = FakeStreamQuery([
+        FakeStream('144p'), FakeStream('360p', video_codec='av01.0.04M.08'), FakeStream('480p'),
+        FakeStream('720p'), FakeStream('240p', extension='webm'), FakeStream(None),
+    ])
+    assert downloads.select_stream(streams, downloads.STREAM_PROFILES['analysis']).resolution == '480p'
+
+
+def test_export_streams_are_the_highest_progressive_stream_in_range():
+    streams = FakeStreamQuery([FakeStream('360p', progressive=True), FakeStream('720p', progressive=True), FakeStream('1080p')])
+    assert downloads.select_stream(streams, downloads.STREAM_PROFILES['export']).resolution == '720p'
+    capped = downloads.STREAM_PROFILES['export']._replace(max_height=480)
+    assert downloads.select_stream(streams, capped).resolution == '360p'
+
+
+@pytest.mark.parametrize('resolutions, expected', [
+    (['144p', '720p', '1080p'], '720p'),  # The closest stream above the range
+    (['144p', '180p'], '180p'),           # Otherwise the closest one below it
+])
+def test_streams_outside_the_range_fall_back_to_the_closest(resolutions, expected):
+    streams = FakeStreamQuery([FakeStream(resolution) for resolution in resolutions])
+    assert downloads.select_stream(streams, downloads.STREAM_PROFILES['analysis']).resolution == expected
+
+
+def test_no_stream_is_selected_without_a_usable_candidate():
+    av1_only = FakeStreamQuery([FakeStream('360p', video_codec='av01.0.04M.08')])
+    assert downloads.select_stream(av1_only, downloads.STREAM_PROFILES['analysis']) is None
+    adaptive_only = FakeStreamQuery([FakeStream('720p')])
+    assert downloads.select_stream(adaptive_only, downloads.STREAM_PROFILES['export']) is None
@@ -0,0 +1,21 @@
+from lru import LRUCache
+from result_store import MemoryResultStore
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats() == {'hits': 3, 'misses': 1, 'entries': 2, 'max_entries': 2}
+
+
+def test_memory_result_store_is_bounded():
+    store = MemoryResultStore(max_entries=2)
+    for token in ('a', 'b', 'c'):
+        store.put(token, {'token': token})
+    assert store.get('a') is None
+    assert store.get('c') == {'token': 'c'}
@@ -0,0 +1,417 @@
+import os
+import subprocess
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from chunked_download import ChunkedDownloader, DownloadProgress
+
+FPS = 10.0
+
+
+class FakeCapture:
+    """VideoCapture stand-in whose frames carry their own frame number in the first pixel."""
+
+    def __init__(self, vp, frame_count):
+        self.vp = vp
+        self.frame_count = frame_count
+        self.position = 0
+
+    def get(self, prop):
+        return {self.vp.cv2.CAP_PROP_FPS: FPS, self.vp.cv2.CAP_PROP_FRAME_WIDTH: 64}.get(prop, 0)
+
+    def grab(self):
+        if self.position >= self.frame_count:
+            return False
+        self.position += 1
+        return True
+
+    def read(self):
+        if self.position >= self.frame_count:
+            return False, None
+        frame = np.zeros((4, 4, 3), dtype=np.uint8)
+        frame[0, 0, :2] = self.position % 256, self.position // 256
+        self.position += 1
+        return True, frame
+
+    def isOpened(self):
+        return True
+
+    def release(self):
+        pass
+
+
+class FakeDetector:
+    """Reports each cut event_buffer_length frames after it happens, like ContentDetector's flash filter."""
+
+    def __init__(self, cuts, delay):
+        self.cuts = cuts
+        self.event_buffer_length = delay
+
+    def process_frame(self, frame_number, frame):
+        return [cut for cut in self.cuts if cut + self.event_buffer_length == frame_number]
+
+    def post_process(self, frame_number):
+        return [cut for cut in self.cuts if cut + self.event_buffer_length > frame_number]
+
+
+def frame_number(frame):
+    return int(frame[0, 0, 0]) + 256 * int(frame[0, 0, 1])
+
+
+@pytest.mark.parametrize('mode', ['all', 'interval', 'keyframes'])
+@pytest.mark.parametrize('delay', [0, 15])
+def test_fused_pass_yields_streaming_samples_without_waiting_for_the_cut(vp, monkeypatch, mode, delay):
+    frame_count, cuts, keyframes = 400, [37, 150, 158, 390], [0, 20, 100, 155, 300, 395]
+    monkeypatch.setattr(vp.cv2, 'VideoCapture', lambda path: FakeCapture(vp, frame_count))
+    monkeypatch.setattr(vp, 'find_keyframe_numbers', lambda path, fps: keyframes)
+    sampling = vp.DEFAULT_FRAME_SAMPLING._replace(mode=mode)
+
+    scene_frames = {}
+    samples = []
+    yielded_before_scene_closed = 0
+    for scene_id, frame in vp.iter_detected_scene_frames('video.mp4', scene_frames, sampling, FakeDetector(cuts, delay)):
+        yielded_before_scene_closed += scene_id not in scene_frames
+        samples.append((scene_id, frame_number(frame)))
+
+    bounds = [0] + cuts + [frame_count]
+    assert [(scene['start_time'].get_frames(), scene['end_time'].get_frames()) for scene in scene_frames.values()] == list(zip(bounds, bounds[1:]))
+    assert samples == [(scene_id, n) for scene_id, (start, end) in enumerate(zip(bounds, bounds[1:]))
+                       for n in vp.select_sample_frames(start, end, FPS, sampling, keyframes)]
+    # Only frames within the detector's delay of a cut have to wait for it
+    assert yielded_before_scene_closed >= len(samples) - (len(cuts) + 1) * (delay + 1)
+
+
+
+def make_video(path, colors, size, seconds=3, faststart=False):
+    """Write an H.264 video of solid colour shots, seconds each at FPS, so every colour change is a cut.
+
+    faststart puts the MP4 index first, so the video can be decoded while it is downloading.
+    """
+    from moviepy.config import get_setting
+    command = [get_setting("FFMPEG_BINARY"), '-hide_banner', '-loglevel', 'error', '-y']
+    for color in colors:
+        command += ['-f', 'lavfi', '-i', f'color=c={color}:s={size}:r={FPS:g}:d={seconds}']
+    inputs = ''.join(f'[{i}]' for i in range(len(colors)))
+    command += ['-filter_complex', f'{inputs}concat=n={len(colors)}:v=1', '-c:v', 'libx264', '-pix_fmt', 'yuv420p']
+    if faststart:
+        command += ['-movflags', '+faststart']
+    command.append(str(path))
+    subprocess.run(command, check=True)
+    return str(path)
+
+
+def scene_bounds(scene_list):
+    return [(start.get_frames(), end.get_frames()) for start, end in scene_list]
+
+
+@pytest.mark.parametrize('size', ['426x240', '640x360'])
+def test_fused_pass_detects_cuts_with_the_real_detector_in_wide_frames(vp, tmp_path, size):
+    # Wider than the detector's 256 px working width, so every frame is downscaled first
+    video_path = make_video(tmp_path / 'video.mp4', ['red', 'blue', 'green'], size)
+    scene_frames = {}
+    list(vp.iter_detected_scene_frames(video_path, scene_frames))
+    assert scene_bounds((scene['start_time'], scene['end_time']) for scene in scene_frames.values()) == [(0, 30), (30, 60), (60, 90)]
+
+
+@pytest.mark.parametrize('colors', [['red', 'blue', 'green'], ['red']])
+def test_fused_and_unfused_passes_find_the_same_scenes(vp, monkeypatch, tmp_path, colors):
+    monkeypatch.setattr(vp, 'SCENE_CACHE_DIRECTORY', str(tmp_path / 'scenes'))
+    video_path = make_video(tmp_path / 'video.mp4', colors, '640x360')
+
+    unfused = scene_bounds(vp.find_scenes(video_path))
+    scene_frames = {}
+    list(vp.iter_detected_scene_frames(video_path, scene_frames))
+    assert scene_bounds((scene['start_time'], scene['end_time']) for scene in scene_frames.values()) == unfused
+    # A video without cuts is cached too, rather than detected again on every request
+    assert scene_bounds(vp.load_cached_scenes(video_path)) == unfused
+
+
+@pytest.mark.parametrize('faststart', [True, False])
+def test_progressive_scene_frames_follow_a_growing_download(vp, monkeypatch, tmp_path, http_server, faststart):
+    monkeypatch.setattr(vp, 'SCENE_CACHE_DIRECTORY', str(tmp_path / 'scenes'))
+    # The video is only a few kB; small, slowly served chunks keep it arriving over a second or so
+    monkeypatch.setattr(vp.downloads, 'chunked_downloader', ChunkedDownloader(chunk_bytes=256, max_workers=1, retries=0))
+    make_video(http_server.directory / 'clip.mp4', ['red', 'blue', 'green'], '640x360', faststart=faststart)
+    http_server.delay = 0.05
+    source = vp.downloads.LocalVideoSource(http_server.url)
+    download = vp.downloads.ProgressiveDownload('clip.mp4', 'analysis', source, vp.downloads.DownloadCache(str(tmp_path / 'cache')))
+
+    scene_frames = {}
+    done_at_first_sample = None
+    for scene_id, frame in vp.iter_progressive_scene_frames(download, scene_frames):
+        if done_at_first_sample is None:
+            done_at_first_sample = download.progress.done
+
+    expected = [(0, 30), (30, 60), (60, 90)]
+    assert scene_bounds((scene['start_time'], scene['end_time']) for scene in scene_frames.values()) == expected
+    assert scene_bounds(vp.load_cached_scenes(download.result())) == expected
+    # A streamable file is decoded as it arrives; one with its index at the end is decoded once complete
+    assert done_at_first_sample is not faststart
+
+
+def test_progressive_scene_frames_give_up_on_a_video_that_delivers_no_bytes(vp, tmp_path):
+    (tmp_path / 'videos').mkdir()
+    (tmp_path / 'videos' / 'empty.mp4').write_bytes(b'')
+    source = vp.downloads.LocalVideoSource(str(tmp_path / 'videos'))
+    download = vp.downloads.ProgressiveDownload('empty.mp4', 'analysis', source, vp.downloads.DownloadCache(str(tmp_path / 'cache')))
+
+    # The FIFO is closed without any data; opening it must fail rather than block forever
+    scene_frames = {}
+    samples = []
+    reader = threading.Thread(target=lambda: samples.extend(vp.iter_progressive_scene_frames(download, scene_frames)), daemon=True)
+    reader.start()
+    reader.join(timeout=30)
+    assert not reader.is_alive()
+    assert samples == [] and scene_frames == {}
+
+
+def test_progressive_embeddings_start_before_any_bytes_arrive(vp, monkeypatch):
+    monkeypatch.setattr(vp, 'PROGRESSIVE_DOWNLOAD', True)
+    monkeypatch.setattr(vp, 'FUSED_PIPELINE', True)
+
+    class Download:
+        progress = DownloadProgress()  # Nothing downloaded yet
+
+    started = threading.Thread(target=vp.stream_progressive_video_embeddings, args=(Download(),), daemon=True)
+    started.start()
+    started.join(timeout=5)
+    assert not started.is_alive()
+
+def test_frame_embedding_store_entries_depend_on_the_detector_config(vp, monkeypatch, tmp_path):
+    video_path = tmp_path / 'video.mp4'
+    video_path.write_bytes(b'video')
+    store = vp.FrameEmbeddingStore(str(tmp_path / 'store'))
+    sampling = vp.DEFAULT_FRAME_SAMPLING
+
+    before = store.entry_directory(str(video_path), sampling)
+    monkeypatch.setattr(vp, 'SCENE_DETECTOR_PARAMS', dict(vp.SCENE_DETECTOR_PARAMS, threshold=40.0))
+    assert store.entry_directory(str(video_path), sampling) != before
+
+
+@pytest.mark.parametrize('start, end, expected', [
+    (0.5, 10.0, 0.4),   # The nearest keyframe, even though it is before the start
+    (2.1, 10.0, 2.0),
+    (2.9, 10.0, 3.0),   # After the start, when that is closer
+    (5.0, 10.0, None),  # Nothing within 0.5 s: re-encode
+    (0.5, 1.0, None),   # 0.1 s is more than 10% of a 0.5 s clip
+    (0.41, 1.0, 0.4),
+])
+def test_snap_to_keyframe_picks_the_nearest_keyframe_within_tolerance(vp, start, end, expected):
+    keyframes = [0.0, 0.4, 2.0, 3.0, 9.9]
+    assert vp.snap_to_keyframe(start, end, keyframes, tolerance_seconds=0.5, tolerance_fraction=0.1) == expected
+
+
+def test_snap_to_keyframe_without_keyframes(vp):
+    assert vp.snap_to_keyframe(1.0, 5.0, []) is None
+
+
+def test_snap_to_keyframe_never_jumps_to_a_keyframe_deep_inside_the_clip(vp):
+    assert vp.snap_to_keyframe(0.5, 10.0, [0.0, 9.9]) == 0.0
+    assert vp.snap_to_keyframe(1.5, 10.0, [0.0, 9.9]) is None
+
+
+def sampling(vp, mode, **params):
+    return vp.DEFAULT_FRAME_SAMPLING._replace(mode=mode, **params)
+
+
+def test_select_sample_frames_all_and_interval(vp):
+    assert vp.select_sample_frames(10, 15, FPS, sampling(vp, 'all')) == [10, 11, 12, 13, 14]
+    assert vp.select_sample_frames(10, 40, FPS, sampling(vp, 'interval', interval_seconds=1.0)) == [10, 20, 30]
+    # Intervals shorter than a frame still advance one frame at a time
+    assert vp.select_sample_frames(0, 3, FPS, sampling(vp, 'interval', interval_seconds=0.01)) == [0, 1, 2]
+
+
+def test_select_sample_frames_per_scene_spreads_samples_over_the_scene(vp):
+    assert vp.select_sample_frames(0, 100, FPS, sampling(vp, 'per_scene', samples_per_scene=4)) == [12, 37, 62, 87]
+    # A scene shorter than the sample count gives every one of its frames
+    assert vp.select_sample_frames(5, 7, FPS, sampling(vp, 'per_scene', samples_per_scene=4)) == [5, 6]
+
+
+def test_select_sample_frames_keyframes_fall_back_to_the_first_frame(vp):
+    keyframes = [0, 20, 45, 90]
+    assert vp.select_sample_frames(10, 50, FPS, sampling(vp, 'keyframes'), keyframes) == [20, 45]
+    assert vp.select_sample_frames(50, 80, FPS, sampling(vp, 'keyframes'), keyframes) == [50]
+    assert vp.select_sample_frames(50, 80, FPS, sampling(vp, 'keyframes')) == [50]
+
+
+def test_select_sample_frames_adaptive_grows_with_duration_within_bounds(vp):
+    adaptive = sampling(vp, 'adaptive', samples_per_scene=2, interval_seconds=1.0, max_samples_per_scene=5)
+    assert len(vp.select_sample_frames(0, 5, FPS, adaptive)) == 2      # 0.5 s: the minimum
+    assert len(vp.select_sample_frames(0, 30, FPS, adaptive)) == 3     # 3 s: one per second
+    assert len(vp.select_sample_frames(0, 1000, FPS, adaptive)) == 5   # 100 s: capped
+
+
+def test_select_sample_frames_rejects_empty_scenes_and_unknown_modes(vp):
+    assert vp.select_sample_frames(10, 10, FPS, sampling(vp, 'all')) == []
+    with pytest.raises(ValueError):
+        vp.select_sample_frames(0, 10, FPS, sampling(vp, 'sometimes'))
+
+
+PHRASES = [f'action {i}' for i in range(10)] + ['context']
+
+
+def scene(vp, start, end):
+    return {'start_time': vp.FrameTimecode(start, FPS), 'end_time': vp.FrameTimecode(end, FPS), 'first_frame': np.zeros((4, 4, 3), np.uint8)}
+
+
+def scores(action):
+    # One row of phrase probabilities, favouring the action phrases or the context phrase
+    row = [0.099 if action else 0.001] * 10
+    return row + [1 - sum(row)]
+
+
+@pytest.fixture
+def classify(vp, monkeypatch):
+    # The batches carry phrase probabilities directly, so no CLIP model is involved
+    monkeypatch.setattr(vp, 'encode_text_features', lambda texts: None)
+    monkeypatch.setattr(vp, 'score_image_features', lambda image_features, text_features: image_features)
+    return lambda scene_frames, batches: vp.iter_classified_scenes(scene_frames, batches, PHRASES)
+
+
+def batch(rows):
+    """An embedding batch of (scene_id, phrase probabilities) rows."""
+    import torch
+    scene_ids, probabilities = zip(*rows)
+    return list(scene_ids), torch.tensor(probabilities)
+
+
+def test_classified_scenes_are_yielded_once_a_later_scene_starts(vp, classify):
+    scene_frames = {0: scene(vp, 0, 10), 1: scene(vp, 10, 20), 2: scene(vp, 20, 30)}
+    pulled = []
+
+    def batches():
+        for rows in ([(0, scores(True)), (0, scores(True))], [(0, scores(True)), (1, scores(False))], [(2, scores(True))]):
+            pulled.append(len(pulled))
+            yield batch(rows)
+
+    results = classify(scene_frames, batches())
+    assert next(results)[0] == 0 and pulled == [0, 1]  # Scene 0 ends in the middle of the second batch
+    scene_id, scene_info = next(results)
+    assert scene_id == 1 and pulled == [0, 1, 2] and scene_info['category'] == 'Context Scene'
+    assert [scene_id for scene_id, _ in results] == [2]
+
+
+def test_classified_scenes_follow_scene_frames_as_it_grows(vp, classify):
+    # As in the fused pass, a scene is only added to scene_frames once it has been detected
+    scene_frames = {}
+
+    def batches():
+        scene_frames[0] = scene(vp, 0, 10)
+        yield batch([(0, scores(True))])
+        scene_frames[1] = scene(vp, 10, 20)
+        scene_frames[2] = scene(vp, 20, 30)
+        yield batch([(1, scores(False)), (2, scores(True))])
+        scene_frames[3] = scene(vp, 30, 40)
+        yield batch([(3, scores(True))])
+
+    results = [(scene_id, scene_info['category']) for scene_id, scene_info in classify(scene_frames, batches())]
+    assert results == [(0, 'Action Scene'), (1, 'Context Scene'), (2, 'Action Scene'), (3, 'Action Scene')]
+
+
+def test_classified_scenes_skip_scenes_without_frames_or_thumbnail(vp, classify):
+    scene_frames = {0: scene(vp, 0, 10), 1: scene(vp, 10, 20), 2: scene(vp, 20, 30)}
+    scene_frames[2]['first_frame'] = None
+    batches = [batch([(0, scores(True)), (2, scores(True))])]  # Scene 1 had no sampled frames
+    assert [scene_id for scene_id, _ in classify(scene_frames, batches)] == [0]
+
+
+def test_abandoned_embedding_passes_are_closed_and_forgotten(vp, monkeypatch):
+    passes = []
+
+    def stream(download, sampling, batch_size):
+        def batches():
+            try:
+                for scene_id in range(100):
+                    yield [scene_id], None
+            except GeneratorExit:
+                passes[-1]['closed'] = True
+                raise
+        passes.append({'closed': False})
+        return {}, batches()
+
+    class Download:
+        key = ('video', 'analysis')
+
+    monkeypatch.setattr(vp, 'stream_progressive_video_embeddings', stream)
+    monkeypatch.setattr(vp, '_embedding_streams', {})
+    _, first = vp.share_video_embeddings(Download())
+    _, second = vp.share_video_embeddings(Download())
+    assert next(first) == next(second) and len(passes) == 1
+
+    first.close()
+    second.close()
+    assert passes[0]['closed'] and vp._embedding_streams == {}
+    _, third = vp.share_video_embeddings(Download())
+    assert next(third) == ([0], None) and len(passes) == 2
+
+
+def test_process_video_concatenates_whole_clips(vp, tmp_path):
+    clip_paths = [make_video(tmp_path / f'{color}.mp4', [color], '128x72', seconds=1) for color in ('red', 'blue')]
+    output_path = str(tmp_path / 'final.mp4')
+    assert vp.process_video(clip_paths, output_path, caption='Caption') == {'path': output_path}
+    with vp.VideoFileClip(output_path) as final:
+        assert final.duration == pytest.approx(2.0, abs=0.15)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['blue.mp4', 'final.mp4', 'red.mp4']
+
+
+def test_render_segments_closes_its_clips_when_writing_fails(vp, monkeypatch, tmp_path):
+    from moviepy.config import get_setting
+    video_path = make_video(tmp_path / 'video.mp4', ['red'], '128x72', seconds=2)
+    audio_path = str(tmp_path / 'audio.m4a')
+    subprocess.run([get_setting("FFMPEG_BINARY"), '-hide_banner', '-loglevel', 'error', '-f', 'lavfi', '-i', 'sine=duration=2', audio_path], check=True)
+    closed = []
+
+    def recording(clip_class):
+        class Recording(clip_class):
+            def close(self):
+                closed.append(clip_class.__name__)
+                super().close()
+        return Recording
+
+    monkeypatch.setattr(vp, 'VideoFileClip', recording(vp.VideoFileClip))
+    monkeypatch.setattr(vp, 'AudioFileClip', recording(vp.AudioFileClip))
+    with pytest.raises(Exception):
+        vp.render_segments([(video_path, 0.5, 1.5)], str(tmp_path / 'missing' / 'final.mp4'), audio_path=audio_path)
+    assert set(closed) == {'AudioFileClip', 'VideoFileClip'}
+
+
+def age(path, seconds):
+    modified = time.time() - seconds
+    os.utime(path, (modified, modified))
+
+
+def test_prune_job_outputs_deletes_old_job_files_only(vp, tmp_path):
+    job = 'a' * 32
+    old_files = [f'{job}_final_video.mp4', f'{job}_scene_3_Action_Scene.mp4']
+    kept = [f'{"b" * 32}_final_video.mp4', 'temp.mp4', 'final_video.mp4']
+    for filename in old_files + kept:
+        (tmp_path / filename).write_bytes(b'video')
+    for filename in old_files + ['temp.mp4', 'final_video.mp4']:
+        age(tmp_path / filename, 2 * 24 * 3600)
+
+    removed = vp.prune_job_outputs(str(tmp_path), max_age=24 * 3600)
+    assert sorted(os.path.basename(path) for path in removed) == sorted(old_files)
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(kept)
+
+
+def test_prune_directory_keeps_the_most_recently_modified_files_within_max_bytes(vp, tmp_path):
+    for i, name in enumerate(['oldest', 'older', 'newest']):
+        (tmp_path / name).write_bytes(b'x' * 100)
+        age(tmp_path / name, 100 - i)
+    assert vp.prune_directory(str(tmp_path), max_bytes=250) == [str(tmp_path / 'oldest')]
+    assert vp.prune_directory(str(tmp_path / 'missing'), max_bytes=0) == []
+
+
+def test_thumbnails_are_evicted_least_recently_used_first(vp, tmp_path):
+    frames = [np.full((90, 160, 3), value, np.uint8) for value in (0, 120, 240)]
+    names = [vp.save_thumbnail(frame, str(tmp_path)) for frame in frames]
+    for i, name in enumerate(names):
+        age(tmp_path / name, 100 - i)
+    size = (tmp_path / names[0]).stat().st_size
+
+    assert vp.save_thumbnail(frames[0], str(tmp_path)) == names[0]  # Used again, so now the newest
+    vp.prune_thumbnails(str(tmp_path), max_bytes=sum((tmp_path / name).stat().st_size for name in names) - size // 2)
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted([names[0], names[2]])
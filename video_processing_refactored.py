@@ -3,18 +3,35 @@ import torch
 import clip
 import os
 from PIL import Image
-from pytube import YouTube
+import downloads
+from coalescing import SharedIterator, SingleFlight
+from lru import LRUCache
 from scenedetect import VideoManager, SceneManager
 from scenedetect.detectors import ContentDetector
+from scenedetect.frame_timecode import FrameTimecode
+from scenedetect.scene_manager import compute_downscale_factor
 from moviepy.editor import VideoFileClip, concatenate_videoclips, AudioFileClip
 from moviepy.video.fx import all
+from moviepy.config import get_setting
 import logging
 import base64
+import bisect
+import hashlib
+import json
+import math
+import re
+import shutil
+import subprocess
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 # Load CLIP model
+CLIP_MODEL_NAME = 'ViT-B/32'
 device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load('ViT-B/32', device=device)
+model, preprocess = clip.load(CLIP_MODEL_NAME, device=device)
 
 # Configure logging to suppress verbose output from libraries
 logging.getLogger('moviepy').setLevel(logging.ERROR)
@@ -23,13 +40,139 @@ logging.getLogger('pyscenedetect').setLevel(logging.ERROR)
 # Define base directory for saving files (adjust as per deployment environment)
 BASE_DIRECTORY = "static/videos"
 
-def download_video(url):
-    yt = YouTube(url)
-    stream = yt.streams.filter(progressive=True, file_extension='mp4').order_by('resolution').desc().first()
-    if stream:
-        return stream.download(output_path=BASE_DIRECTORY)
+# Number of frames stacked into a single CLIP encode_image call
+CLIP_BATCH_SIZE = int(os.environ.get('CLIP_BATCH_SIZE', 32))
+
+# Frame sampling used to pick the frames of each scene that are scored with CLIP.
+#   all:       every decoded frame
+#   per_scene: samples_per_scene evenly spaced frames
+#   interval:  one frame every interval_seconds
+#   keyframes: only the encoder's keyframes (falls back to the scene's first frame)
+#   adaptive:  one frame per interval_seconds, at least samples_per_scene and at most max_samples_per_scene
+FRAME_SAMPLING_MODES = ('all', 'per_scene', 'interval', 'keyframes', 'adaptive')
+FrameSampling = namedtuple('FrameSampling', ['mode', 'samples_per_scene', 'interval_seconds', 'max_samples_per_scene'])
+DEFAULT_FRAME_SAMPLING = FrameSampling(
+    mode=os.environ.get('FRAME_SAMPLING', 'adaptive'),
+    samples_per_scene=int(os.environ.get('SAMPLES_PER_SCENE', 3)),
+    interval_seconds=float(os.environ.get('SAMPLE_INTERVAL_SECONDS', 1.0)),
+    max_samples_per_scene=int(os.environ.get('MAX_SAMPLES_PER_SCENE', 16)),
+)
+
+# Detect scenes and pick CLIP samples from the same decode pass instead of decoding twice
+FUSED_PIPELINE = os.environ.get('FUSED_PIPELINE', '1') == '1'
+
+# Start the fused pass on the downloaded prefix of a video instead of waiting for the whole file
+PROGRESSIVE_DOWNLOAD = os.environ.get('PROGRESSIVE_DOWNLOAD', '1') == '1'
+
+# Precomputed artefacts share the download cache's root directory
+EMBEDDING_CACHE_DIRECTORY = os.path.join(downloads.CACHE_DIRECTORY, 'embeddings')
+SCENE_CACHE_DIRECTORY = os.path.join(downloads.CACHE_DIRECTORY, 'scenes')
+FRAME_EMBEDDING_CACHE_DIRECTORY = os.path.join(downloads.CACHE_DIRECTORY, 'frame_embeddings')
+THUMBNAIL_DIRECTORY = os.path.join(downloads.CACHE_DIRECTORY, 'thumbnails')
+
+# Scene thumbnails: maximum width in pixels, encoder quality, "jpg" or "webp", and browser cache lifetime
+THUMBNAIL_WIDTH = int(os.environ.get('THUMBNAIL_WIDTH', 320))
+THUMBNAIL_QUALITY = int(os.environ.get('THUMBNAIL_QUALITY', 80))
+THUMBNAIL_FORMAT = os.environ.get('THUMBNAIL_FORMAT', 'jpg')
+THUMBNAIL_MAX_AGE = int(os.environ.get('THUMBNAIL_MAX_AGE', 7 * 24 * 3600))
+
+# Total size of THUMBNAIL_DIRECTORY before the least recently used thumbnails are deleted
+THUMBNAIL_CACHE_MAX_BYTES = int(os.environ.get('THUMBNAIL_CACHE_MAX_BYTES', 256 * 1024 ** 2))
+
+# Final videos and scene clips are named by job (see JOB_OUTPUT_PATTERN) and deleted once older than this many seconds
+JOB_OUTPUT_MAX_AGE = float(os.environ.get('JOB_OUTPUT_MAX_AGE', 24 * 3600))
+JOB_OUTPUT_PATTERN = re.compile(r'^[0-9a-f]{32}_(final_video|scene_\d+_\w+)\.mp4$')
+
+# How save_clip exports scenes: "copy" snaps the start to a keyframe and stream-copies with ffmpeg,
+# "reencode" cuts exactly and re-encodes with libx264
+CLIP_EXPORT_MODE = os.environ.get('CLIP_EXPORT_MODE', 'copy')
+
+# Largest start shift "copy" accepts, in seconds and as a fraction of the clip; beyond it the clip is re-encoded
+KEYFRAME_SNAP_TOLERANCE_SECONDS = float(os.environ.get('KEYFRAME_SNAP_TOLERANCE_SECONDS', 0.5))
+KEYFRAME_SNAP_TOLERANCE_FRACTION = float(os.environ.get('KEYFRAME_SNAP_TOLERANCE_FRACTION', 0.1))
+
+# Parallel clip export: x264 threads given to each encode, and how many clips are exported at once
+X264_THREADS_PER_WORKER = int(os.environ.get('X264_THREADS_PER_WORKER', 2))
+CLIP_EXPORT_WORKERS = int(os.environ.get('CLIP_EXPORT_WORKERS', max(1, (os.cpu_count() or 1) // X264_THREADS_PER_WORKER)))
+
+# ContentDetector parameters; part of the scene cache key so changing them invalidates cached scenes
+SCENE_DETECTOR_PARAMS = {'threshold': 27.0, 'min_scene_len': 15}
+
+# Maximum number of custom phrase embeddings kept in memory
+TEXT_EMBEDDING_CACHE_SIZE = int(os.environ.get('TEXT_EMBEDDING_CACHE_SIZE', 1024))
+
+# Built-in description phrases per category. The first ten phrases of each set describe action, the rest context.
+CATEGORY_PHRASES = {
+    "1": ["Mountain biker doing a downhill run", "Rider jumping over an obstacle", "Cyclist on a rocky trail", "Biking through forest trails", "MTB stunt on a dirt path",
+        "Close-up of a mountain bike wheel", "Mountain biker navigating a sharp turn", "First-person view of a bike ride", "Mountain biker doing a trick jump", "Biking fast down a steep incline",
+        "Biker with a helmet on talking to the camera", "People standing around", "a person facing and talking to the camera", "Introducing the context for a video", "a zoomed-out scene of nature without any people in it",
+        "Scene showing a mountain biking terrain park", "Biker taking it easy going down a hill", "mountain Biker falling and crashing", "People walking outside", "Context scene with mountain bikers not performing any tricks"],
+    "2": ["Skier jumping off a snow ramp", "Person skiing down a snowy mountain", "Close-up of skis on snow", "Skiing through a snowy forest", "Skier performing a spin",
+        "Point-of-view shot from a ski helmet", "Group of skiers on a mountain", "Skier sliding on a rail", "Snow spraying from skis", "Skier in mid-air during a jump",
+        "Person being interviewed after an event", "People in a crowd cheering", "Sitting inside of a vehicle", "Skaters standing around a ramp", "People standing around at an event",
+        "Commercial break", "People having a conversation", "Person in a helmet talking to the camera", "person facing the camera", "People introducing the context for a video",],
+    "3": ["Surfer riding a big wave", "Close-up of a surfboard on water", "Surfer performing a cutback", "Wave curling over a surfer", "Aerial view of a surf competition",
+        "Surfer paddling on a board", "Surfboard leaving a trail in the water", "Surfer in a tube wave", "Surfer wiping out on a wave", "Longboard surfer cruising a wave",
+        "Surfers lounging on the beach", "Paddling to catch a wave", "a surfer surveying the waves sitting on their surfboard", "People standing holding their surfboards",
+        "Standing on the beach", "Interviewing a surfer after their performance", "multiple faces in the frame", "Surfer paddling out to get ready for a wave",
+        "Surfer in the water sitting on their surfboard", "Beginner surfer struggling to stand on their board"]
+}
+
+def download_video(url, profile=downloads.DEFAULT_PROFILE):
+    # Served from the download cache when the same video was fetched before
+    return downloads.fetch_video(url, profile)
+
+def video_id(url):
+    try:
+        return downloads.video_source.video_id(url)
+    except Exception:
+        return url  # Unparseable URLs fail later, in the download stage
+
+def start_video_download(url, profile=downloads.DEFAULT_PROFILE):
+    # Returns immediately, joining a download of the same video that is still running
+    return downloads.start_progressive_download(url, profile)
+
+def download_segments(url, intervals, profile=downloads.DEFAULT_PROFILE):
+    # Only the byte ranges covering each (start_seconds, end_seconds) interval
+    return downloads.fetch_segments(url, intervals, profile)
+
+def download_audio(url, duration=None):
+    # Only the soundtrack, optionally trimmed to duration seconds
+    return downloads.fetch_audio(url, duration)
+
+def thumbnail_frame(frame, width=THUMBNAIL_WIDTH):
+    """Downscale frame to at most width pixels wide, keeping its aspect ratio."""
+    if frame.shape[1] <= width:
+        return frame
+    height = max(1, round(frame.shape[0] * width / frame.shape[1]))
+    return cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+
+def save_thumbnail(frame, directory=THUMBNAIL_DIRECTORY, width=THUMBNAIL_WIDTH, quality=THUMBNAIL_QUALITY, image_format=THUMBNAIL_FORMAT):
+    """Write a downscaled thumbnail of frame named by its content hash, and return the file name."""
+    if image_format == 'webp':
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
     else:
-        return None
+        image_format = 'jpg'
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    _, buffer = cv2.imencode(f'.{image_format}', thumbnail_frame(frame, width), params)
+    data = buffer.tobytes()
+
+    filename = f"{hashlib.sha256(data).hexdigest()[:20]}.{image_format}"
+    path = os.path.join(directory, filename)
+    try:
+        # Marks the thumbnail as recently used for prune_thumbnails
+        os.utime(path)
+    except FileNotFoundError:
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return filename
+
+def prune_thumbnails(directory=THUMBNAIL_DIRECTORY, max_bytes=THUMBNAIL_CACHE_MAX_BYTES):
+    """Delete the least recently used thumbnails until the rest fit in max_bytes."""
+    return prune_directory(directory, max_bytes=max_bytes, matches=lambda filename: filename.endswith(('.jpg', '.webp')))
 
 def image_to_base64(image):
     _, buffer = cv2.imencode('.jpg', image)
@@ -38,97 +181,731 @@ def image_to_base64(image):
 
 
 
+_content_hashes = {}
+
+def file_content_hash(path):
+    """SHA-256 of a file's contents, memoised by path, size and modification time."""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if memo_key not in _content_hashes:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        _content_hashes[memo_key] = digest.hexdigest()
+    return _content_hashes[memo_key]
+
+def scene_detector_key():
+    """Short hash of the scene detector config; anything caching scene boundaries includes it in its key."""
+    return hashlib.sha256(json.dumps(['content', SCENE_DETECTOR_PARAMS], sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+def scene_cache_path(video_path):
+    return os.path.join(SCENE_CACHE_DIRECTORY, f"{file_content_hash(video_path)}_{scene_detector_key()}.json")
+
+def load_cached_scenes(video_path):
+    """Return the cached scene list for this video and detector config, or None."""
+    try:
+        with open(scene_cache_path(video_path)) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    fps = cached['fps']
+    return [(FrameTimecode(start, fps=fps), FrameTimecode(end, fps=fps)) for start, end in cached['scenes']]
+
+def save_cached_scenes(video_path, scene_list):
+    if not scene_list:
+        return
+    cache_path = scene_cache_path(video_path)
+    cached = {
+        'fps': scene_list[0][0].get_framerate(),
+        'detector': 'content',
+        'params': SCENE_DETECTOR_PARAMS,
+        'scenes': [[start.get_frames(), end.get_frames()] for start, end in scene_list],
+    }
+    try:
+        os.makedirs(SCENE_CACHE_DIRECTORY, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(cached, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logging.warning(f"Could not write scene cache {cache_path}: {e}")
+
 def find_scenes(video_path):
+    scene_list = load_cached_scenes(video_path)
+    if scene_list is not None:
+        return scene_list
+
     video_manager = VideoManager([video_path])
     scene_manager = SceneManager()
-    scene_manager.add_detector(ContentDetector())
+    scene_manager.add_detector(ContentDetector(**SCENE_DETECTOR_PARAMS))
     video_manager.set_downscale_factor()
     video_manager.start()
     scene_manager.detect_scenes(frame_source=video_manager)
-    scene_list = scene_manager.get_scene_list(video_manager.get_base_timecode())
+    # A video without cuts is one scene, as in the fused pass, rather than none
+    scene_list = scene_manager.get_scene_list(video_manager.get_base_timecode(), start_in_scene=True)
     video_manager.release()
+    save_cached_scenes(video_path, scene_list)
     return scene_list
 
-def extract_frames(video_path, scene_list):
-    scene_frames = {}
+def video_frame_count(video_path):
     cap = cv2.VideoCapture(video_path)
-    for i, (start_time, end_time) in enumerate(scene_list):
-        frames = []
-        first_frame = None
-        cap.set(cv2.CAP_PROP_POS_FRAMES, start_time.get_frames())
-        while cap.get(cv2.CAP_PROP_POS_FRAMES) < end_time.get_frames():
-            ret, frame = cap.read()
-            if ret:
-                if first_frame is None:
-                    first_frame = frame
-                frames.append(frame)
-        scene_frames[i] = {'start_time': start_time, 'end_time': end_time, 'frames': frames, 'first_frame': first_frame}
-        print(f"Extracted frames for scene {i}: First frame type: {type(first_frame)}, Total frames extracted: {len(frames)}")
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     cap.release()
+    return frame_count
+
+_keyframe_times = {}
+
+def find_keyframe_times(video_path):
+    """Return the sorted timestamps in seconds of the video's keyframes, as reported by ffmpeg."""
+    stat = os.stat(video_path)
+    memo_key = (os.path.abspath(video_path), stat.st_size, stat.st_mtime)
+    if memo_key not in _keyframe_times:
+        command = [get_setting("FFMPEG_BINARY"), '-hide_banner', '-skip_frame', 'nokey', '-i', video_path,
+                   '-an', '-vf', 'showinfo', '-f', 'null', '-']
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        _keyframe_times[memo_key] = sorted({float(pts_time) for pts_time in re.findall(r'pts_time:\s*([0-9.]+)', result.stderr)})
+    return _keyframe_times[memo_key]
+
+def find_keyframe_numbers(video_path, fps):
+    """Return the sorted frame numbers of the video's keyframes."""
+    return sorted({int(round(pts_time * fps)) for pts_time in find_keyframe_times(video_path)})
+
+def evenly_spaced_frames(start_frame, end_frame, count):
+    length = end_frame - start_frame
+    if count >= length:
+        return list(range(start_frame, end_frame))
+    return sorted({start_frame + int((i + 0.5) * length / count) for i in range(count)})
+
+def select_sample_frames(start_frame, end_frame, fps, sampling, keyframes=None):
+    """Pick the frame numbers in [start_frame, end_frame) that should be scored for a scene."""
+    if end_frame <= start_frame:
+        return []
+    duration = (end_frame - start_frame) / fps if fps else 0
+
+    if sampling.mode == 'all':
+        return list(range(start_frame, end_frame))
+    if sampling.mode == 'per_scene':
+        return evenly_spaced_frames(start_frame, end_frame, sampling.samples_per_scene)
+    if sampling.mode == 'interval':
+        step = max(1, int(round(sampling.interval_seconds * fps)))
+        return list(range(start_frame, end_frame, step))
+    if sampling.mode == 'keyframes':
+        selected = [n for n in (keyframes or []) if start_frame <= n < end_frame]
+        return selected or [start_frame]
+    if sampling.mode == 'adaptive':
+        count = math.ceil(duration / sampling.interval_seconds) if sampling.interval_seconds > 0 else 0
+        count = min(sampling.max_samples_per_scene, max(sampling.samples_per_scene, count))
+        return evenly_spaced_frames(start_frame, end_frame, count)
+    raise ValueError(f"Unknown frame sampling mode: {sampling.mode}")
+
+def scene_metadata(scene_list):
+    """Build the per-scene dict shared by frame extraction and classification, without any frames."""
+    return {i: {'start_time': start_time, 'end_time': end_time, 'first_frame': None}
+            for i, (start_time, end_time) in enumerate(scene_list)}
+
+def iter_video_frames(cap, wanted=None, last_frame=None):
+    """Read a freshly opened capture forward once, yielding (frame_number, frame).
+
+    Frames for which wanted(frame_number) is false are grabbed but not retrieved. Frame
+    numbers are counted locally rather than read back from CAP_PROP_POS_FRAMES, and the
+    loop ends at end of stream, on the first failed read, or after last_frame.
+    """
+    frame_number = 0
+    while last_frame is None or frame_number <= last_frame:
+        if wanted is not None and not wanted(frame_number):
+            if not cap.grab():
+                break
+        else:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            yield frame_number, frame
+        frame_number += 1
+
+def iter_scene_frames(video_path, scene_frames, sampling=DEFAULT_FRAME_SAMPLING):
+    """Decode the sampled frames of each scene in a single forward pass, yielding (scene_id, frame).
+
+    The first frame of every scene is stored in scene_frames[scene_id]['first_frame']
+    before any of that scene's samples are yielded.
+    """
+    if sampling.mode not in FRAME_SAMPLING_MODES:
+        raise ValueError(f"Unknown frame sampling mode: {sampling.mode}")
+
+    cap = cv2.VideoCapture(video_path)
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        keyframes = find_keyframe_numbers(video_path, fps) if sampling.mode == 'keyframes' else None
+
+        # Map every frame we need to its scene, from the sorted scene boundaries
+        first_frames = {}
+        samples = {}
+        for scene_id, scene_data in scene_frames.items():
+            start_frame = scene_data['start_time'].get_frames()
+            first_frames[start_frame] = scene_id
+            for frame_number in select_sample_frames(start_frame, scene_data['end_time'].get_frames(), fps, sampling, keyframes):
+                samples[frame_number] = scene_id
+        if not first_frames:
+            return
+        last_frame = max(max(first_frames), max(samples, default=0))
+
+        sample_count = 0
+        for frame_number, frame in iter_video_frames(cap, lambda n: n in first_frames or n in samples, last_frame):
+            if frame_number in first_frames:
+                # Only ever used as the scene thumbnail, so keep a downscaled copy
+                scene_frames[first_frames[frame_number]]['first_frame'] = thumbnail_frame(frame)
+            if frame_number in samples:
+                sample_count += 1
+                yield samples[frame_number], frame
+        print(f"Extracted {sample_count} frames across {len(scene_frames)} scenes")
+    finally:
+        cap.release()
+
+def batched(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def iter_frame_batches(video_path, scene_frames, sampling=DEFAULT_FRAME_SAMPLING, batch_size=CLIP_BATCH_SIZE):
+    """Stream lists of up to batch_size (scene_id, frame) pairs, crossing scene boundaries."""
+    return batched(iter_scene_frames(video_path, scene_frames, sampling), batch_size)
+
+def nearest_candidates(candidates, targets):
+    """Pick, for every target frame number, the closest buffered (frame_number, frame) candidate."""
+    if not candidates:
+        return []
+    numbers = [frame_number for frame_number, _ in candidates]
+    chosen = {}
+    for target in targets:
+        i = bisect.bisect_left(numbers, target)
+        best = min((j for j in (i - 1, i) if 0 <= j < len(numbers)), key=lambda j: abs(numbers[j] - target))
+        chosen[numbers[best]] = candidates[best][1]
+    return [chosen[frame_number] for frame_number in sorted(chosen)]
+
+def detector_input(frame):
+    """Downscale frame for scene detection exactly as SceneManager does, so both pipelines find the same cuts."""
+    height, width = frame.shape[:2]
+    downscale = compute_downscale_factor(max(width, height))
+    if downscale <= 1:
+        return frame
+    return cv2.resize(frame, (max(1, round(width / downscale)), max(1, round(height / downscale))), interpolation=cv2.INTER_LINEAR)
+
+def iter_detected_scene_frames(video_path, scene_frames, sampling=DEFAULT_FRAME_SAMPLING, detector=None, backend=None):
+    """Detect scenes and pick their CLIP samples from a single decode pass, yielding (scene_id, frame).
+
+    Every frame is fed to a ContentDetector. Frames that may become samples of the open scene
+    wait in a pending buffer; once the detector confirms the scene's end, the scene is added to
+    scene_frames and its samples are yielded. For per_scene/adaptive sampling, where the sample
+    positions depend on the scene length, the buffer is decimated so it stays bounded. For
+    all/interval/keyframes sampling a frame's fate is known as soon as no later cut can move it
+    into the next scene, so samples are yielded after the detector's event delay and the buffer
+    holds only that many frames. Those samples carry the id the scene gets when it is closed.
+
+    backend pins the OpenCV capture backend (e.g. cv2.CAP_FFMPEG). Nothing is yielded, and
+    scene_frames stays empty, if the video cannot be opened.
+    """
+    if sampling.mode not in FRAME_SAMPLING_MODES:
+        raise ValueError(f"Unknown frame sampling mode: {sampling.mode}")
+
+    detector = detector or ContentDetector(**SCENE_DETECTOR_PARAMS)
+    cap = cv2.VideoCapture(video_path) if backend is None else cv2.VideoCapture(video_path, backend)
+    try:
+        if not cap.isOpened():
+            logging.warning(f"Could not open {video_path} for scene detection")
+            return
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        keyframes = find_keyframe_numbers(video_path, fps) if sampling.mode == 'keyframes' else []
+        keyframe_set = set(keyframes)
+        interval_step = max(1, int(round(sampling.interval_seconds * fps)))
+        buffer_capacity = 4 * max(1, sampling.max_samples_per_scene if sampling.mode == 'adaptive' else sampling.samples_per_scene)
+
+        streaming = sampling.mode in ('all', 'interval', 'keyframes')
+        # A cut is reported at most this many frames after the frame it happens at
+        cut_delay = getattr(detector, 'event_buffer_length', 0)
+
+        scene_start = 0
+        first_frame = None
+        pending = []
+        stride = 1
+        held_start = None
+
+        def is_candidate(frame_number):
+            offset = frame_number - scene_start
+            if offset == 0 or streaming:
+                return True
+            return offset % stride == 0
+
+        def is_target(frame_number):
+            # Sample positions of the open scene in the streaming modes; they depend only on its start
+            if sampling.mode == 'all':
+                return True
+            if sampling.mode == 'interval':
+                return (frame_number - scene_start) % interval_step == 0
+            return frame_number in keyframe_set
+
+        def release_frames(last_frame):
+            """Yield the open scene's samples among pending frames up to last_frame."""
+            nonlocal held_start
+            scene_id = len(scene_frames)
+            while pending and pending[0][0] <= last_frame:
+                frame_number, frame = pending.pop(0)
+                if is_target(frame_number):
+                    held_start = None
+                    yield scene_id, frame
+                elif frame_number == scene_start and sampling.mode == 'keyframes':
+                    held_start = (frame_number, frame)  # Scored only if the scene has no keyframe
+
+        def close_scene(end_frame):
+            nonlocal scene_start, first_frame, pending, stride, held_start
+            scene_id = len(scene_frames)
+            scene_frames[scene_id] = {'start_time': FrameTimecode(scene_start, fps=fps), 'end_time': FrameTimecode(end_frame, fps=fps), 'first_frame': first_frame}
+            targets = select_sample_frames(scene_start, end_frame, fps, sampling, keyframes)
+            candidates = [c for c in pending if c[0] < end_frame]
+            if streaming:
+                if held_start is not None:
+                    candidates.insert(0, held_start)
+                    held_start = None
+                target_set = set(targets)
+                samples = [frame for frame_number, frame in candidates if frame_number in target_set]
+            else:
+                samples = nearest_candidates(candidates, targets)
+
+            # Frames already buffered past the cut belong to the next scene
+            pending = [c for c in pending if c[0] >= end_frame]
+            scene_start, stride = end_frame, 1
+            first_frame = thumbnail_frame(pending[0][1]) if pending and pending[0][0] == end_frame else None
+            return scene_id, samples
+
+        frame_number = -1
+        for frame_number, frame in iter_video_frames(cap):
+            for cut in detector.process_frame(frame_number, detector_input(frame)):
+                if cut > scene_start:
+                    scene_id, samples = close_scene(cut)
+                    for sample in samples:
+                        yield scene_id, sample
+
+            if first_frame is None:
+                first_frame = thumbnail_frame(frame)
+            if is_candidate(frame_number):
+                pending.append((frame_number, frame))
+                if sampling.mode in ('per_scene', 'adaptive') and len(pending) > buffer_capacity:
+                    pending = pending[::2]
+                    stride *= 2
+            if streaming:
+                yield from release_frames(frame_number - cut_delay)
+
+        if frame_number < 0:
+            return
+        for cut in detector.post_process(frame_number) or []:
+            if scene_start < cut <= frame_number:
+                scene_id, samples = close_scene(cut)
+                for sample in samples:
+                    yield scene_id, sample
+        scene_id, samples = close_scene(frame_number + 1)
+        for sample in samples:
+            yield scene_id, sample
+        print(f"Detected {len(scene_frames)} scenes in a single decode pass")
+    finally:
+        cap.release()
+
+def iter_detected_and_cached_scene_frames(video_path, scene_frames, sampling=DEFAULT_FRAME_SAMPLING):
+    yield from iter_detected_scene_frames(video_path, scene_frames, sampling)
+    save_cached_scenes(video_path, [(scene_data['start_time'], scene_data['end_time']) for scene_data in scene_frames.values()])
+
+def stream_video_frames(video_path, sampling=DEFAULT_FRAME_SAMPLING, batch_size=CLIP_BATCH_SIZE, fused=FUSED_PIPELINE):
+    """Return (scene_frames, frame_batches) ready for classify_and_categorize_scenes.
+
+    Known videos reuse their cached scene list and skip detection. Otherwise, in fused mode
+    scene_frames starts empty and is filled as frame_batches is consumed.
+    """
+    cached_scenes = load_cached_scenes(video_path)
+    if fused and cached_scenes is None:
+        scene_frames = {}
+        return scene_frames, batched(iter_detected_and_cached_scene_frames(video_path, scene_frames, sampling), batch_size)
+    scene_frames = scene_metadata(cached_scenes if cached_scenes is not None else find_scenes(video_path))
+    return scene_frames, iter_frame_batches(video_path, scene_frames, sampling, batch_size)
+
+def iter_progressive_scene_frames(download, scene_frames, sampling=DEFAULT_FRAME_SAMPLING):
+    """Fused detection and sampling on a video that is still downloading, yielding (scene_id, frame).
+
+    Frames are decoded from a FIFO fed with the downloaded prefix, so detection follows the
+    download head. Containers that cannot be decoded front to back (an MP4 with its index at
+    the end) yield nothing from the FIFO and are decoded again once the file is complete.
+    """
+    with download.pipe() as fifo_path:
+        # Only the FFMPEG backend reads a FIFO; others would reopen it after the feeder is gone and block
+        yield from iter_detected_scene_frames(fifo_path, scene_frames, sampling, backend=cv2.CAP_FFMPEG)
+    video_path = download.result()
+    if not scene_frames:
+        logging.info(f"Could not decode {video_path} while downloading, decoding the complete file")
+        yield from iter_detected_scene_frames(video_path, scene_frames, sampling)
+    save_cached_scenes(video_path, [(scene_data['start_time'], scene_data['end_time']) for scene_data in scene_frames.values()])
+
+def extract_frames(video_path, scene_list, sampling=DEFAULT_FRAME_SAMPLING):
+    """Decode all sampled frames into memory. Prefer iter_frame_batches for long videos."""
+    scene_frames = scene_metadata(scene_list)
+    for scene_data in scene_frames.values():
+        scene_data['frames'] = []
+    for scene_id, frame in iter_scene_frames(video_path, scene_frames, sampling):
+        scene_frames[scene_id]['frames'].append(frame)
     return scene_frames
 
-def classify_and_categorize_scenes(scene_frames, description_phrases):
-    scene_categories = {}
-    description_texts = description_phrases
+# Custom phrase embeddings, keyed by (model name, exact phrase text)
+text_embedding_cache = LRUCache(TEXT_EMBEDDING_CACHE_SIZE)
+
+def encode_texts(texts):
+    """Tokenize and encode phrases with CLIP, returning L2-normalised float32 embeddings as a numpy array."""
+    with torch.no_grad():
+        text_inputs = clip.tokenize(texts).to(device)
+        text_features = model.encode_text(text_inputs)
+        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+    return text_features.float().cpu().numpy()
+
+# Registry of precomputed phrase embeddings, keyed by exact phrase text
+PHRASE_EMBEDDINGS = {}
+
+def phrase_set_cache_path(phrases):
+    digest = hashlib.sha256("\n".join([CLIP_MODEL_NAME] + list(phrases)).encode('utf-8')).hexdigest()[:16]
+    model_slug = CLIP_MODEL_NAME.replace('/', '-')
+    return os.path.join(EMBEDDING_CACHE_DIRECTORY, f"{model_slug}_{digest}.npy")
+
+def load_phrase_set(phrases):
+    """Load a phrase set's embeddings from the on-disk cache, encoding and caching them on a miss."""
+    cache_path = phrase_set_cache_path(phrases)
+    embeddings = None
+    if os.path.exists(cache_path):
+        try:
+            embeddings = np.load(cache_path)
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable embedding cache {cache_path}: {e}")
+        if embeddings is not None and embeddings.shape[0] != len(phrases):
+            embeddings = None
+
+    if embeddings is None:
+        embeddings = encode_texts(phrases)
+        try:
+            os.makedirs(EMBEDDING_CACHE_DIRECTORY, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.save(f, embeddings)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logging.warning(f"Could not write embedding cache {cache_path}: {e}")
+
+    for phrase, embedding in zip(phrases, embeddings):
+        PHRASE_EMBEDDINGS[phrase] = embedding
+    return embeddings
+
+def load_category_embeddings():
+    for phrases in CATEGORY_PHRASES.values():
+        load_phrase_set(phrases)
+
+def encode_text_features(description_texts):
+    """Return L2-normalised CLIP text features, encoding only phrases missing from the registry and LRU cache."""
+    embeddings = {}
+    missing = []
+    for phrase in dict.fromkeys(description_texts):
+        embedding = PHRASE_EMBEDDINGS.get(phrase)
+        if embedding is None:
+            embedding = text_embedding_cache.get((CLIP_MODEL_NAME, phrase))
+        if embedding is None:
+            missing.append(phrase)
+        else:
+            embeddings[phrase] = embedding
+
+    if missing:
+        for phrase, embedding in zip(missing, encode_texts(missing)):
+            text_embedding_cache.put((CLIP_MODEL_NAME, phrase), embedding)
+            embeddings[phrase] = embedding
+
+    rows = [embeddings[phrase] for phrase in description_texts]
+    return torch.from_numpy(np.stack(rows)).to(device=device, dtype=model.dtype)
+
+# Precompute the built-in category embeddings once at startup
+load_category_embeddings()
+
+def encode_image_batch(frames):
+    """Preprocess a list of BGR frames and encode them with CLIP in one forward pass."""
+    images = [preprocess(Image.fromarray(frame[..., ::-1])) for frame in frames]
+    image_input = torch.stack(images).to(device)
+    with torch.no_grad():
+        image_features = model.encode_image(image_input)
+    return image_features / image_features.norm(dim=-1, keepdim=True)
+
+def score_image_features(image_features, text_features):
+    """Return per-frame softmax probabilities over the encoded description phrases."""
+    with torch.no_grad():
+        logits = model.logit_scale.exp() * image_features @ text_features.T
+    return logits.softmax(dim=-1)
+
+class FrameEmbeddingStore:
+    """On-disk float16 CLIP embeddings of each video's sampled frames.
+
+    Entries are keyed by video content hash, CLIP model, scene detector config and frame
+    sampling config. Each one is a directory holding embeddings.npy, scene_ids.npy (the scene
+    of every row), the scenes' first frames as JPEGs and meta.json with the scene boundaries.
+    """
+
+    def __init__(self, directory=FRAME_EMBEDDING_CACHE_DIRECTORY):
+        self.directory = directory
+
+    def entry_directory(self, video_path, sampling):
+        sampling_key = hashlib.sha256(json.dumps(sampling._asdict(), sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        model_slug = CLIP_MODEL_NAME.replace('/', '-')
+        return os.path.join(self.directory, f"{file_content_hash(video_path)}_{model_slug}_{scene_detector_key()}_{sampling_key}")
+
+    def load(self, video_path, sampling):
+        """Return (scene_frames, scene_ids, embeddings) for a stored video, or None."""
+        entry_directory = self.entry_directory(video_path, sampling)
+        try:
+            with open(os.path.join(entry_directory, 'meta.json')) as f:
+                meta = json.load(f)
+            scene_ids = np.load(os.path.join(entry_directory, 'scene_ids.npy'))
+            embeddings = np.load(os.path.join(entry_directory, 'embeddings.npy'), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+        fps = meta['fps']
+        scene_frames = {}
+        for scene_id, (start, end) in enumerate(meta['scenes']):
+            first_frame = cv2.imread(os.path.join(entry_directory, f"first_frame_{scene_id}.jpg"))
+            scene_frames[scene_id] = {'start_time': FrameTimecode(start, fps=fps), 'end_time': FrameTimecode(end, fps=fps), 'first_frame': first_frame}
+        return scene_frames, scene_ids, embeddings
+
+    def save(self, video_path, sampling, scene_frames, scene_ids, embeddings):
+        entry_directory = self.entry_directory(video_path, sampling)
+        if os.path.exists(entry_directory) or not scene_frames:
+            return
+        tmp_directory = f"{entry_directory}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(tmp_directory)
+            np.save(os.path.join(tmp_directory, 'scene_ids.npy'), np.asarray(scene_ids, dtype=np.int32))
+            np.save(os.path.join(tmp_directory, 'embeddings.npy'), np.asarray(embeddings, dtype=np.float16))
+            for scene_id, scene_data in scene_frames.items():
+                if isinstance(scene_data['first_frame'], np.ndarray):
+                    cv2.imwrite(os.path.join(tmp_directory, f"first_frame_{scene_id}.jpg"), scene_data['first_frame'])
+            meta = {
+                'fps': next(iter(scene_frames.values()))['start_time'].get_framerate(),
+                'model': CLIP_MODEL_NAME,
+                'sampling': sampling._asdict(),
+                'scenes': [[d['start_time'].get_frames(), d['end_time'].get_frames()] for d in scene_frames.values()],
+            }
+            with open(os.path.join(tmp_directory, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            os.rename(tmp_directory, entry_directory)
+        except OSError as e:
+            logging.warning(f"Could not write frame embeddings to {entry_directory}: {e}")
+        finally:
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+
+frame_embedding_store = FrameEmbeddingStore()
+
+def iter_frame_embeddings(frame_batches, on_complete=None):
+    """Encode streamed (scene_id, frame) batches, yielding (scene_ids, image_features).
+
+    If every batch encodes successfully, on_complete(scene_ids, embeddings) is called with all
+    rows once the stream ends.
+    """
+    all_scene_ids = []
+    all_embeddings = []
+    failed = False
+    for batch in frame_batches:
+        scene_ids = [scene_id for scene_id, _ in batch]
+        try:
+            image_features = encode_image_batch([frame for _, frame in batch])
+        except Exception as e:
+            print(f"An error occurred while processing frame batch: {e}")
+            failed = True
+            continue
+        if on_complete is not None:
+            all_scene_ids.extend(scene_ids)
+            all_embeddings.append(image_features.half().cpu().numpy())
+        yield scene_ids, image_features
+
+    if on_complete is not None and not failed and all_embeddings:
+        on_complete(all_scene_ids, np.concatenate(all_embeddings))
+
+def stream_video_embeddings(video_path, sampling=DEFAULT_FRAME_SAMPLING, batch_size=CLIP_BATCH_SIZE, fused=FUSED_PIPELINE):
+    """Return (scene_frames, embedding_batches) for iter_classified_scenes.
+
+    Videos already in the frame embedding store are re-scored from their stored embeddings
+    in one batch, without decoding; otherwise frames are decoded, encoded and then stored.
+    """
+    stored = frame_embedding_store.load(video_path, sampling)
+    if stored is not None:
+        scene_frames, scene_ids, embeddings = stored
+        image_features = torch.from_numpy(np.asarray(embeddings)).to(device=device, dtype=model.dtype)
+        return scene_frames, iter([(scene_ids.tolist(), image_features)] if len(scene_ids) else [])
+
+    scene_frames, frame_batches = stream_video_frames(video_path, sampling, batch_size, fused)
+
+    def save_embeddings(scene_ids, embeddings):
+        frame_embedding_store.save(video_path, sampling, scene_frames, scene_ids, embeddings)
+
+    return scene_frames, iter_frame_embeddings(frame_batches, save_embeddings)
+
+def stream_progressive_video_embeddings(download, sampling=DEFAULT_FRAME_SAMPLING, batch_size=CLIP_BATCH_SIZE):
+    """stream_video_embeddings for a ProgressiveDownload, starting before the download is complete.
+
+    Videos that were already downloaded, and configurations that need the whole file first
+    (keyframe sampling, the unfused pipeline), go through stream_video_embeddings instead.
+    """
+    if download.progress.done or not PROGRESSIVE_DOWNLOAD or not FUSED_PIPELINE or sampling.mode == 'keyframes':
+        return stream_video_embeddings(download.result(), sampling, batch_size)
+
+    scene_frames = {}
+    frame_batches = batched(iter_progressive_scene_frames(download, scene_frames, sampling), batch_size)
+
+    def save_embeddings(scene_ids, embeddings):
+        frame_embedding_store.save(download.result(), sampling, scene_frames, scene_ids, embeddings)
+
+    return scene_frames, iter_frame_embeddings(frame_batches, save_embeddings)
+
+def analysis_config():
+    """Settings besides the video and phrases that determine a pipeline run's results."""
+    return {'model': CLIP_MODEL_NAME, 'sampling': DEFAULT_FRAME_SAMPLING._asdict(), 'detector': SCENE_DETECTOR_PARAMS}
+
+# Embedding passes in progress, so jobs on the same video share one decode and CLIP pass
+_embedding_streams = {}
+_embedding_streams_lock = threading.Lock()
+_embedding_stream_starts = SingleFlight()
+
+def share_video_embeddings(download, sampling=DEFAULT_FRAME_SAMPLING, batch_size=CLIP_BATCH_SIZE):
+    """stream_progressive_video_embeddings, shared by every caller on the same download and sampling.
+
+    Scene detection and image embeddings do not depend on the phrases, so a job attaching to a
+    pass in progress replays the batches produced so far and then follows the same pass. Once a
+    pass is complete, later jobs read its results from the scene cache and embedding store.
+    If every job on a pass stops early, the pass is closed and the next job starts a new one.
+    """
+    key = (download.key, sampling, batch_size)
+
+    def forget(shared):
+        with _embedding_streams_lock:
+            if key in _embedding_streams and _embedding_streams[key][1] is shared:
+                del _embedding_streams[key]
+
+    def start():
+        with _embedding_streams_lock:
+            for finished_key in [k for k, (_, shared) in _embedding_streams.items() if shared.done]:
+                del _embedding_streams[finished_key]
+            entry = _embedding_streams.get(key)
+        if entry is None:
+            scene_frames, embedding_batches = stream_progressive_video_embeddings(download, sampling, batch_size)
+            shared = SharedIterator(embedding_batches, on_close=lambda: forget(shared))
+            entry = (scene_frames, shared)
+            with _embedding_streams_lock:
+                _embedding_streams[key] = entry
+        return entry
+
+    while True:
+        scene_frames, shared = _embedding_stream_starts.do(key, start)
+        reader = shared.attach()
+        if reader is not None:
+            return scene_frames, reader
+        # The last job on this pass left just before we attached; start() now begins a new one
+        forget(shared)
+
+def categorize_scene(scene_data, scene_scores, valid_frames, description_texts):
+    if valid_frames == 0:
+        return None
 
     action_indices = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
     context_indices = list(set(range(len(description_texts))) - set(action_indices))
 
-    for scene_id, scene_data in scene_frames.items():
-        frames = scene_data['frames']
+    scene_scores = [score / valid_frames for score in scene_scores]
+    action_confidence = sum(scene_scores[i] for i in action_indices) / len(action_indices)
+    context_confidence = sum(scene_scores[i] for i in context_indices) / len(context_indices)
+
+    best_description_index = scene_scores.index(max(scene_scores))
+    best_description = description_texts[best_description_index]
+
+    if action_confidence > context_confidence:
+        category = "Action Scene"
+        confidence = action_confidence
+    else:
+        category = "Context Scene"
+        confidence = context_confidence
+
+    duration = scene_data['end_time'].get_seconds() - scene_data['start_time'].get_seconds()
+    return {
+        "category": category,
+        "confidence": confidence,
+        "start_time": str(scene_data['start_time']),
+        "end_time": str(scene_data['end_time']),
+        "duration": duration,
+        "first_frame": scene_data['first_frame'],  # Assuming first_frame is already handled as numpy array
+        "best_description": best_description
+    }
+
+def iter_classified_scenes(scene_frames, embedding_batches, description_phrases):
+    """Score streamed (scene_ids, image_features) batches, yielding (scene_id, scene_info) as soon
+    as each scene is complete.
+
+    embedding_batches must deliver rows in scene order; a scene is complete once a later
+    scene's rows arrive or the stream ends. Only running per-scene score sums are kept.
+    """
+    description_texts = description_phrases
+
+    # The phrase set is identical for every frame, so encode it once up front
+    text_features = encode_text_features(description_texts)
+
+    # scene_frames may still be growing while batches arrive (see iter_detected_scene_frames),
+    # so scenes are finished by walking its insertion order with a cursor
+    finished_count = 0
+    scene_scores = {}
+    valid_frames = {}
+
+    def finish_scene(scene_id):
+        scene_data = scene_frames[scene_id]
         first_frame = scene_data['first_frame']
+        scores = scene_scores.pop(scene_id, [0] * len(description_texts))
+        count = valid_frames.pop(scene_id, 0)
 
         # Debug output to verify the type of the first_frame
         if not isinstance(first_frame, np.ndarray):
             print(f"Error: First frame for scene {scene_id} is not a numpy array. Type: {type(first_frame)}")
-            continue  # Skip this scene if the first frame is not a numpy array
+            return None  # Skip this scene if the first frame is not a numpy array
+        return categorize_scene(scene_data, scores, count, description_texts)
 
-        scene_scores = [0] * len(description_texts)
-        valid_frames = 0
+    for batch_scene_ids, image_features in embedding_batches:
+        probs = score_image_features(image_features, text_features)
+        for scene_id, frame_probs in zip(batch_scene_ids, probs.tolist()):
+            scores = scene_scores.get(scene_id, [0] * len(description_texts))
+            scene_scores[scene_id] = [sum(x) for x in zip(scores, frame_probs)]
+            valid_frames[scene_id] = valid_frames.get(scene_id, 0) + 1
 
-        for frame in frames:
-            try:
-                image = Image.fromarray(frame[..., ::-1])
-                image_input = preprocess(image).unsqueeze(0).to(device)
-                with torch.no_grad():
-                    text_inputs = clip.tokenize(description_texts).to(device)
-                    text_features = model.encode_text(text_inputs)
-                    image_features = model.encode_image(image_input)
-                    logits = (image_features @ text_features.T).squeeze()
-                    probs = logits.softmax(dim=0)
-                    scene_scores = [sum(x) for x in zip(scene_scores, probs.tolist())]
-                    valid_frames += 1
-            except Exception as e:
-                print(f"An error occurred while processing frame: {e}")
-                continue
-
-        if valid_frames > 0:
-            scene_scores = [score / valid_frames for score in scene_scores]
-            action_confidence = sum(scene_scores[i] for i in action_indices) / len(action_indices)
-            context_confidence = sum(scene_scores[i] for i in context_indices) / len(context_indices)
-
-            best_description_index = scene_scores.index(max(scene_scores))
-            best_description = description_texts[best_description_index]
+        # Every scene before the last one seen in this batch has received all of its frames
+        scene_ids = list(scene_frames)
+        current_scene_id = batch_scene_ids[-1]
+        while finished_count < len(scene_ids) and scene_ids[finished_count] != current_scene_id:
+            scene_id = scene_ids[finished_count]
+            finished_count += 1
+            scene_info = finish_scene(scene_id)
+            if scene_info is not None:
+                yield scene_id, scene_info
 
-            if action_confidence > context_confidence:
-                category = "Action Scene"
-                confidence = action_confidence
-            else:
-                category = "Context Scene"
-                confidence = context_confidence
-
-            duration = scene_data['end_time'].get_seconds() - scene_data['start_time'].get_seconds()
-            scene_categories[scene_id] = {
-                "category": category,
-                "confidence": confidence,
-                "start_time": str(scene_data['start_time']),
-                "end_time": str(scene_data['end_time']),
-                "duration": duration,
-                "first_frame": first_frame,  # Assuming first_frame is already handled as numpy array
-                "best_description": best_description
-            }
+    for scene_id in list(scene_frames)[finished_count:]:
+        scene_info = finish_scene(scene_id)
+        if scene_info is not None:
+            yield scene_id, scene_info
 
-    return scene_categories
+def classify_and_categorize_scenes(scene_frames, description_phrases, batch_size=CLIP_BATCH_SIZE, frame_batches=None, embedding_batches=None):
+    """Classify every scene. Pass frame_batches (see iter_frame_batches) to stream frames instead
+    of reading them from each scene's 'frames' list, or embedding_batches (see
+    stream_video_embeddings) to re-score already encoded frames."""
+    if embedding_batches is None:
+        if frame_batches is None:
+            # Batch frames across scene boundaries so each encode_image call sees batch_size frames
+            frame_refs = ((scene_id, frame) for scene_id, scene_data in scene_frames.items() for frame in scene_data['frames'])
+            frame_batches = batched(frame_refs, batch_size)
+        embedding_batches = iter_frame_embeddings(frame_batches)
+    return dict(iter_classified_scenes(scene_frames, embedding_batches, description_phrases))
 
 def add_text_with_opencv(frame, text, font_scale=2.0, font=cv2.FONT_HERSHEY_COMPLEX, color=(255, 255, 0), thickness=3):
     frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
@@ -141,39 +918,185 @@ def add_text_with_opencv(frame, text, font_scale=2.0, font=cv2.FONT_HERSHEY_COMP
     cv2.putText(frame, text, (text_x, text_y), font, font_scale, color, thickness, cv2.LINE_AA)
     return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
     
+def render_caption_overlay(frame_size, text, font_scale=2.0, font=cv2.FONT_HERSHEY_COMPLEX, color=(255, 255, 0), thickness=3):
+    """Render a caption once, exactly where add_text_with_opencv would draw it.
+
+    Returns (x, y, patch, inverse_alpha) covering only the caption's bounding box, where patch
+    is premultiplied RGB, or None if nothing would be visible.
+    """
+    width, height = frame_size
+    canvas = np.zeros((height, width, 3), dtype=np.uint8)
+    mask = np.zeros((height, width), dtype=np.uint8)
+
+    text_size, _ = cv2.getTextSize(text, font, font_scale, thickness)
+    text_width, text_height = text_size
+    text_x = (width - text_width) // 2
+    text_y = (height + text_height) // 2
+
+    # The canvas is already black, so the background box only needs to be drawn into the mask
+    cv2.rectangle(mask, (text_x, text_y - text_height - 10), (text_x + text_width, text_y + 10), 255, -1)
+    cv2.putText(canvas, text, (text_x, text_y), font, font_scale, color, thickness, cv2.LINE_AA)
+    cv2.putText(mask, text, (text_x, text_y), font, font_scale, 255, thickness, cv2.LINE_AA)
+
+    ys, xs = np.nonzero(mask)
+    if len(ys) == 0:
+        return None
+    y0, y1, x0, x1 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+    patch = cv2.cvtColor(canvas[y0:y1, x0:x1], cv2.COLOR_BGR2RGB).astype(np.float32)
+    inverse_alpha = 1.0 - mask[y0:y1, x0:x1, None].astype(np.float32) / 255.0
+    return int(x0), int(y0), patch, inverse_alpha
+
+def composite_overlay(frame, overlay):
+    """Alpha-blend a render_caption_overlay result onto an RGB frame, touching only its bounding box."""
+    if overlay is None:
+        return frame
+    x, y, patch, inverse_alpha = overlay
+    height, width = patch.shape[:2]
+    output = frame.copy()
+    region = output[y:y + height, x:x + width]
+    output[y:y + height, x:x + width] = np.clip(patch + region * inverse_alpha, 0, 255).astype(np.uint8)
+    return output
+
 def process_video(clip_paths, output_path, caption=None, audio_path=None):
+    """Concatenate whole clip files into one video; see render_segments."""
+    return render_segments([(path, 0, None) for path in clip_paths], output_path, caption=caption, audio_path=audio_path)
+
+def snap_to_keyframe(start_seconds, end_seconds, keyframe_times,
+                     tolerance_seconds=KEYFRAME_SNAP_TOLERANCE_SECONDS, tolerance_fraction=KEYFRAME_SNAP_TOLERANCE_FRACTION):
+    """Move a clip start onto the nearest keyframe so it can be stream-copied.
+
+    Returns None, meaning the clip has to be re-encoded, if there is no keyframe within
+    tolerance_seconds and within tolerance_fraction of the clip's length of the start.
+    """
+    tolerance = min(tolerance_seconds, tolerance_fraction * (end_seconds - start_seconds))
+    i = bisect.bisect_left(keyframe_times, start_seconds)
+    nearby = [keyframe_times[j] for j in (i - 1, i) if 0 <= j < len(keyframe_times)]
+    if not nearby:
+        return None
+    nearest = min(nearby, key=lambda keyframe_time: abs(keyframe_time - start_seconds))
+    return nearest if abs(nearest - start_seconds) <= tolerance else None
+
+def stream_copy_clip(video_path, start_seconds, end_seconds, output_filepath, keyframe_times=None):
+    """Cut [start_seconds, end_seconds) out of video_path without re-encoding; return True on success.
+
+    keyframe_times (see find_keyframe_times) is probed from the video when not given.
+    """
+    if keyframe_times is None:
+        keyframe_times = find_keyframe_times(video_path)
+    snapped_start = snap_to_keyframe(start_seconds, end_seconds, keyframe_times)
+    if snapped_start is None or snapped_start >= end_seconds:
+        return False
+
+    command = [get_setting("FFMPEG_BINARY"), '-hide_banner', '-loglevel', 'error', '-y',
+               '-ss', f"{snapped_start:.6f}", '-i', video_path, '-t', f"{end_seconds - snapped_start:.6f}",
+               '-map', '0:v:0', '-map', '0:a?', '-c', 'copy', '-avoid_negative_ts', 'make_zero',
+               '-movflags', '+faststart', output_filepath]
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        logging.warning(f"Stream copy of {video_path} failed: {result.stderr.strip()}")
+        return False
+    return os.path.exists(output_filepath)
+
+def render_segments(segments, output_path, caption=None, audio_path=None):
+    """Render (source_path, start_seconds, end_seconds) segments into one video with a single encode.
+
+    Each source is opened once and the timeline is assembled from subclips, so no per-scene
+    intermediate files are written. An end_seconds of None runs to the end of the source.
+    """
     print("Starting video processing...")
-    clips = [VideoFileClip(path) for path in clip_paths]
-    final_clip = concatenate_videoclips(clips, method="compose")
+    sources = {}
+    final_clip = audio_clip = None
+    # moviepy would otherwise put this in the working directory and leave it there if writing fails
+    temp_audio_path = f"{os.path.splitext(output_path)[0]}.audio.tmp.m4a"
+    try:
+        clips = []
+        for source_path, start_seconds, end_seconds in segments:
+            if source_path not in sources:
+                sources[source_path] = VideoFileClip(source_path)
+            clips.append(sources[source_path].subclip(start_seconds, end_seconds))
+        final_clip = concatenate_videoclips(clips, method="compose")
 
-    if caption:
-        print("Adding caption...")
-        final_clip = final_clip.fl_image(lambda frame: add_text_with_opencv(frame, caption))
+        if caption:
+            print("Adding caption...")
+            caption_overlay = render_caption_overlay(final_clip.size, caption)
+            final_clip = final_clip.fl_image(lambda frame: composite_overlay(frame, caption_overlay))
 
-    if audio_path:
-        print("Adding audio overlay...")
-        audio_clip = AudioFileClip(audio_path).set_duration(final_clip.duration)
-        final_clip = final_clip.set_audio(audio_clip)
+        if audio_path:
+            print("Adding audio overlay...")
+            audio_clip = AudioFileClip(audio_path)
+            final_clip = final_clip.set_audio(audio_clip.set_duration(final_clip.duration))
 
-    print(f"Writing final video to {output_path}...")
-    final_clip.write_videofile(output_path, codec='libx264', audio_codec='aac', verbose=False)
-    final_clip.close()
+        print(f"Writing final video to {output_path}...")
+        final_clip.write_videofile(output_path, codec='libx264', audio_codec='aac', temp_audiofile=temp_audio_path, verbose=False, logger=None)
+    finally:
+        # Closed even when writing fails, so no ffmpeg reader processes are left behind
+        for clip in (final_clip, audio_clip, *sources.values()):
+            if clip is not None:
+                clip.close()
+        if os.path.exists(temp_audio_path):
+            os.remove(temp_audio_path)
     print("Video processing complete. Output saved to:", output_path)
     return {"path": output_path}
 
-def save_clip(video_path, scene_info, output_directory, scene_id):
+def prune_directory(directory, max_age=None, max_bytes=None, matches=None):
+    """Delete files older than max_age seconds, then the least recently modified ones until the rest fit in max_bytes.
+
+    Only files for which matches(filename) is true are considered. Returns the paths deleted.
+    """
+    files = []
+    try:
+        filenames = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    for filename in filenames:
+        if matches is not None and not matches(filename):
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+
+    files.sort()
+    now = time.time()
+    total_bytes = sum(size for _, size, _ in files)
+    removed = []
+    for modified, size, path in files:
+        expired = max_age is not None and now - modified > max_age
+        if not expired and (max_bytes is None or total_bytes <= max_bytes):
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+        removed.append(path)
+    return removed
+
+def prune_job_outputs(directory, max_age=JOB_OUTPUT_MAX_AGE):
+    """Delete final videos and scene clips of jobs older than max_age seconds from directory."""
+    return prune_directory(directory, max_age=max_age, matches=lambda filename: JOB_OUTPUT_PATTERN.match(filename) is not None)
+
+def save_clip(video_path, scene_info, output_directory, scene_id, export_mode=CLIP_EXPORT_MODE, job_id=None, threads=None, keyframe_times=None):
     # Ensure the output directory exists
     os.makedirs(output_directory, exist_ok=True)
     
     output_filename = f"scene_{scene_id+1}_{scene_info['category'].replace(' ', '_')}.mp4"
+    if job_id:
+        # Keep concurrent jobs from overwriting each other's clips
+        output_filename = f"{job_id}_{output_filename}"
     output_filepath = os.path.join(output_directory, output_filename)
     
     try:
         start_seconds = convert_timestamp_to_seconds(scene_info['start_time'])
         end_seconds = convert_timestamp_to_seconds(scene_info['end_time'])
-    
+
+        if export_mode == 'copy' and stream_copy_clip(video_path, start_seconds, end_seconds, output_filepath, keyframe_times):
+            return {"path": output_filepath}
+
         video_clip = VideoFileClip(video_path).subclip(start_seconds, end_seconds)
-        video_clip.write_videofile(output_filepath, codec='libx264', audio_codec='aac', verbose=False, logger=None)
+        video_clip.write_videofile(output_filepath, codec='libx264', audio_codec='aac', threads=threads, verbose=False, logger=None)
         video_clip.close()
 
         # Check if the file was actually created
@@ -188,6 +1111,47 @@ def save_clip(video_path, scene_info, output_directory, scene_id):
         return None
 
 
+class ClipExportError(Exception):
+    """Raised by export_clips when some clips could not be written; failures maps index to reason."""
+
+    def __init__(self, failures, paths):
+        super().__init__(f"Failed to export {len(failures)} clip(s): " + ", ".join(f"#{i}: {reason}" for i, reason in sorted(failures.items())))
+        self.failures = failures
+        self.paths = paths
+
+def export_clip_task(video_path, scene_info, output_directory, scene_id, export_mode, job_id, threads, keyframe_times):
+    clip_info = save_clip(video_path, scene_info, output_directory, scene_id, export_mode, job_id, threads, keyframe_times)
+    if clip_info is None:
+        raise RuntimeError(f"Failed to save clip for scene {scene_id + 1}")
+    return clip_info['path']
+
+def export_clips(video_path, scenes, output_directory, job_id=None, export_mode=CLIP_EXPORT_MODE,
+                 max_workers=CLIP_EXPORT_WORKERS, threads_per_worker=X264_THREADS_PER_WORKER):
+    """Export (scene_id, scene_info) pairs in parallel on a bounded thread pool.
+
+    The encoding and stream copies run in ffmpeg subprocesses, so threads are enough; each
+    x264 encode is limited to threads_per_worker threads so the pool does not oversubscribe
+    the CPU. The video's keyframes are probed once for all clips. Returns the clip paths in
+    input order, or raises ClipExportError naming every clip that failed.
+    """
+    if not scenes:
+        return []
+    keyframe_times = find_keyframe_times(video_path) if export_mode == 'copy' else None
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(scenes)), thread_name_prefix='clip-export') as executor:
+        futures = [executor.submit(export_clip_task, video_path, scene_info, output_directory, scene_id, export_mode, job_id, threads_per_worker, keyframe_times)
+                   for scene_id, scene_info in scenes]
+        paths = []
+        failures = {}
+        for i, future in enumerate(futures):
+            try:
+                paths.append(future.result())
+            except Exception as e:
+                paths.append(None)
+                failures[i] = str(e)
+    if failures:
+        raise ClipExportError(failures, paths)
+    return paths
+
 def convert_timestamp_to_seconds(timestamp):
     """Convert a timestamp in HH:MM:SS format to seconds."""
     h, m, s = map(float, timestamp.split(':'))